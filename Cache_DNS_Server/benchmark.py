@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from dnslib import DNSRecord, QTYPE, RCODE, RR, A, SOA
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_PORT = 5353
+UPSTREAM_PORT = 5354
+REPORT_INTERVAL = 1
+QUERY_TIMEOUT = 2
+
+# every scenario is a set of defaults for the command line options
+SCENARIOS = {
+    'hit': dict(names=1000, zipf=1.2, ttl=3600, nxdomain=0.0, max_entries=100000),
+    'expiry': dict(names=200000, zipf=0.9, ttl=2, nxdomain=0.05, max_entries=20000),
+    'persistence': dict(names=50000, zipf=1.0, ttl=3600, nxdomain=0.02, max_entries=100000, restart=True),
+}
+
+
+class StubUpstream(asyncio.DatagramProtocol):
+    """Stand-in upstream: answers every query itself after a fixed latency."""
+
+    def __init__(self, latency, ttl, nxdomain, answers, counter):
+        self.latency = latency
+        self.ttl = ttl
+        self.nxdomain = nxdomain
+        self.answers = answers
+        self.counter = counter
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        with self.counter.get_lock():
+            self.counter.value += 1
+        asyncio.get_running_loop().call_later(self.latency, self.transport.sendto, self.answer(data), address)
+
+    def answer(self, data):
+        query = DNSRecord.parse(data)
+        reply = query.reply()
+        name = str(query.q.qname)
+        # the same name always gets the same kind of answer
+        if zlib.crc32(name.encode()) % 10000 < self.nxdomain * 10000:
+            reply.header.rcode = RCODE.NXDOMAIN
+            reply.add_auth(RR('bench.', QTYPE.SOA, rdata=SOA('ns.bench.', 'admin.bench.', (1, 60, 60, 60, self.ttl)),
+                              ttl=self.ttl))
+        elif query.q.qtype == QTYPE.A:
+            for i in range(self.answers):
+                reply.add_answer(RR(name, QTYPE.A, rdata=A(f'10.{i}.0.1'), ttl=self.ttl))
+        return reply.pack()
+
+
+def run_upstream(port, latency, ttl, nxdomain, answers, counter):
+    async def serve():
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: StubUpstream(latency, ttl, nxdomain, answers, counter), local_addr=('127.0.0.1', port))
+        await asyncio.Event().wait()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve())
+
+
+class ZipfNames:
+    def __init__(self, count, exponent, seed):
+        self.names = [f'host{i}.bench.' for i in range(count)]
+        total = 0
+        self.cumulative = []
+        for rank in range(1, count + 1):
+            total += 1 / rank ** exponent
+            self.cumulative.append(total)
+        self.random = random.Random(seed)
+        self.queries = {}  # name -> packed query without the ID
+
+    def next(self):
+        position = bisect.bisect(self.cumulative, self.random.random() * self.cumulative[-1])
+        return self.names[min(position, len(self.names) - 1)]
+
+    def next_query(self):
+        name = self.next()
+        query = self.queries.get(name)
+        if query is None:
+            query = self.queries[name] = bytes(DNSRecord.question(name).pack()[2:])
+        return query
+
+
+class LoadGenerator(asyncio.DatagramProtocol):
+    """Open-loop client: sends at the target rate whatever the answers do, so queueing shows up in latency."""
+
+    def __init__(self, names):
+        self.names = names
+        self.transport = None
+        self.sent_at = {}  # transaction ID -> send time
+        self.latencies = []
+        self.sent = self.answered = self.lost = self.servfail = 0
+        self.next_id = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        sent_at = self.sent_at.pop(data[:2], None)
+        if sent_at is None:
+            return
+        self.latencies.append(time.perf_counter() - sent_at)
+        self.answered += 1
+        if data[3] & 0x0F == RCODE.SERVFAIL:
+            self.servfail += 1
+
+    def send(self, count):
+        now = time.perf_counter()
+        for _ in range(count):
+            query_id = struct.pack('!H', self.next_id)
+            self.next_id = (self.next_id + 1) % 65536
+            if query_id in self.sent_at:
+                self.lost += 1
+            self.sent_at[query_id] = now
+            self.transport.sendto(query_id + self.names.next_query())
+            self.sent += 1
+
+    def expire(self):
+        deadline = time.perf_counter() - QUERY_TIMEOUT
+        for query_id in [query_id for query_id, sent_at in self.sent_at.items() if sent_at < deadline]:
+            del self.sent_at[query_id]
+            self.lost += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rss_kib(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def start_server(args, cache_file):
+    command = [sys.executable, os.path.join(HERE, 'cache_dns.py'), '--host', '127.0.0.1',
+               '--port', str(args.port), '--upstream', '127.0.0.1', '--upstream-port', str(args.upstream_port),
+               '--cache', cache_file, '--max-entries', str(args.max_entries)]
+    if args.serve_stale:
+        command.append('--serve-stale')
+    started = time.perf_counter()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    probe = DNSRecord.question('ready.bench.').pack()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.05)
+        while server.poll() is None:
+            sock.sendto(probe, ('127.0.0.1', args.port))
+            try:
+                sock.recvfrom(65535)
+                return server, time.perf_counter() - started
+            except OSError:
+                pass
+    raise RuntimeError('cache_dns.py exited on start')
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+async def load(args, names, server, upstream_queries, phase):
+    loop = asyncio.get_running_loop()
+    transport, generator = await loop.create_datagram_endpoint(
+        lambda: LoadGenerator(names), remote_addr=('127.0.0.1', args.port))
+    started = time.perf_counter()
+    report_at = started + REPORT_INTERVAL
+    upstream_before = upstream_at_report = upstream_queries.value
+    sent_at_report = 0
+    reports = []
+    while (now := time.perf_counter()) < started + args.duration:
+        generator.send(int((now - started) * args.qps) - generator.sent)
+        if now >= report_at:
+            generator.expire()
+            latencies = sorted(generator.latencies)
+            generator.latencies.clear()
+            sent = generator.sent - sent_at_report
+            upstream = upstream_queries.value - upstream_at_report
+            report = dict(phase=phase, t=round(now - started, 1), qps=round(len(latencies) / REPORT_INTERVAL),
+                          hit_ratio=round(1 - upstream / sent, 4) if sent else 0,
+                          p50_ms=round(percentile(latencies, 0.5) * 1000, 3),
+                          p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+                          p999_ms=round(percentile(latencies, 0.999) * 1000, 3),
+                          lost=generator.lost, rss_kib=rss_kib(server.pid))
+            reports.append(report)
+            show(args, report)
+            sent_at_report, upstream_at_report = generator.sent, upstream_queries.value
+            report_at += REPORT_INTERVAL
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(QUERY_TIMEOUT)
+    generator.expire()
+    transport.close()
+    upstream = upstream_queries.value - upstream_before
+    return dict(phase=phase, sent=generator.sent, answered=generator.answered, lost=generator.lost,
+                servfail=generator.servfail, upstream_queries=upstream,
+                hit_ratio=round(1 - upstream / generator.sent, 4) if generator.sent else 0,
+                mean_qps=round(generator.answered / args.duration), reports=reports)
+
+
+def show(args, report):
+    if args.json:
+        print(json.dumps(report), flush=True)
+    elif 'sent' in report:
+        print(f"{report['phase']}: sent {report['sent']}, answered {report['answered']}, lost {report['lost']}, "
+              f"servfail {report['servfail']}, upstream {report['upstream_queries']}, "
+              f"hit ratio {report['hit_ratio']:.2%}, mean {report['mean_qps']} qps", flush=True)
+    elif 'startup_s' in report:
+        print(f"{report['phase']}: started in {report['startup_s']:.3f} s, "
+              f"cache files {report['cache_bytes']} bytes", flush=True)
+    else:
+        print(f"{report['phase']:>8} {report['t']:6.1f}s {report['qps']:8d} qps  hit {report['hit_ratio']:7.2%}  "
+              f"p50 {report['p50_ms']:8.3f}  p99 {report['p99_ms']:8.3f}  p999 {report['p999_ms']:8.3f} ms  "
+              f"lost {report['lost']:6d}  rss {report['rss_kib'] // 1024} MiB", flush=True)
+
+
+def cache_bytes(cache_file):
+    return sum(os.path.getsize(f) for f in (cache_file, cache_file + '.journal') if os.path.exists(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test of cache_dns.py against a local stub upstream')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='hit')
+    parser.add_argument('--qps', type=int, default=5000, help='target queries per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per phase')
+    parser.add_argument('--names', type=int, help='size of the name set')
+    parser.add_argument('--zipf', type=float, help='Zipf exponent of name popularity')
+    parser.add_argument('--latency', type=float, default=0.02, help='stub upstream latency, seconds')
+    parser.add_argument('--ttl', type=int, help='TTL of stub answers')
+    parser.add_argument('--nxdomain', type=float, help='share of names answered with NXDOMAIN')
+    parser.add_argument('--answers', type=int, default=2, help='A records per positive answer')
+    parser.add_argument('--max-entries', type=int)
+    parser.add_argument('--serve-stale', action='store_true')
+    parser.add_argument('--restart', action='store_true', help='restart the server and load it again from disk')
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--upstream-port', type=int, default=UPSTREAM_PORT)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print JSON lines instead of a table')
+    parser.set_defaults(restart=None)
+    args = parser.parse_args()
+    for option, value in SCENARIOS[args.scenario].items():
+        if getattr(args, option) is None:
+            setattr(args, option, value)
+    args.restart = bool(args.restart)
+
+    upstream_queries = multiprocessing.Value('q', 0)
+    upstream = multiprocessing.Process(target=run_upstream, daemon=True, args=(
+        args.upstream_port, args.latency, args.ttl, args.nxdomain, args.answers, upstream_queries))
+    upstream.start()
+    names = ZipfNames(args.names, args.zipf, args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache_file = os.path.join(directory, 'cache.txt')
+        try:
+            for phase in ('cold', 'restart') if args.restart else ('run',):
+                server, startup = start_server(args, cache_file)
+                report = dict(phase=phase, startup_s=round(startup, 3), cache_bytes=cache_bytes(cache_file))
+                show(args, report)
+                results.append(report)
+                try:
+                    result = asyncio.run(load(args, names, server, upstream_queries, phase))
+                finally:
+                    stop_server(server)
+                show(args, result)
+                results.append(result)
+        finally:
+            upstream.terminate()
+    return results
+
+
+if __name__ == '__main__':
+    main()
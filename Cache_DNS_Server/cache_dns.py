@@ -1,127 +1,973 @@
-import pickle
-import time
+import argparse
+import asyncio
+import heapq
+import mmap
+import os
 import random
-from socket import socket, AF_INET, SOCK_DGRAM, timeout
-from dnslib import DNSRecord, QTYPE, RR, A, AAAA, NS, PTR
-
-qtype_to_int = {1: (QTYPE.A, A),
-                2: (QTYPE.NS, NS),
-                12: (QTYPE.PTR, PTR),
-                28: (QTYPE.AAAA, AAAA)}
-ROOT_SERVER = "8.8.8.8",  # Google Public DNS
+import struct
+import sys
+import time
+from collections import OrderedDict
+from socket import SOL_SOCKET, SO_RCVBUF
+from dnslib import DNSRecord, DNSQuestion, DNSError, QTYPE, RCODE, RR
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Metrics, Reporter, add_arguments, options  # noqa: E402
+
+ROOT_SERVER = "8.8.8.8"  # Google Public DNS
+UPSTREAM_PORT = 53
+UPSTREAM_TIMEOUT = 4
+UPSTREAM_ATTEMPTS = 3
+MAX_REFERRALS = 16  # referrals followed for one query before giving up
+UPSTREAM_SOCKETS = 4  # long-lived UDP sockets shared by all upstream queries
+UPSTREAM_SOCKET_LIFETIME = 60  # seconds before a socket is replaced by one on a new random port
+RECEIVE_BUFFER = 4 * 1024 * 1024  # SO_RCVBUF of the listening socket, absorbs bursts
+UDP_PAYLOAD = 512  # largest UDP answer for clients without EDNS (RFC 1035)
+TRUNCATED = 0x02  # TC bit in the third byte of the header
+RECURSION_DESIRED = 0x01  # RD bit in the third byte of the header
+CHECKING_DISABLED = 0x10  # CD bit in the fourth byte of the header
+FLUSH_INTERVAL = 1
+MAX_CACHE_ENTRIES = 100000
+MAX_CNAME_CHAIN = 8
+PREFETCH_HITS = 8  # hits during one TTL period that make an entry hot
+PREFETCH_WINDOW = 0.1  # hot entries are refreshed within this fraction of their TTL
+SERVE_STALE = False
+STALE_TTL = 30  # RFC 8767 recommends 30 seconds
+MAX_STALE = 24 * 60 * 60  # how long expired entries are kept for serve-stale
+NXDOMAIN_TYPE = 0  # reserved qtype, NXDOMAIN entries cover every type of a name
 CACHE_FILE = "cache.txt"
+JOURNAL_SUFFIX = ".journal"
+NEXT_JOURNAL_SUFFIX = ".journal.next"  # records written while a new snapshot is being made
+COMPACT_JOURNAL_SIZE = 4 * 1024 * 1024
+SNAPSHOT_MAGIC = b"DNSC\x01"
+# op, expires_at, q_type, rcode, name length, payload length; then name and packed RRs
+RECORD = struct.Struct("!cdHHHI")
+INSERT, DELETE = b"I", b"D"
+POSITIVE = 0xFFFF  # rcode field of positive entries
+
+
+class Entry:
+    __slots__ = ('_rrs', 'raw', 'expires_at', 'rcode', 'hits')
+
+    def __init__(self, rrs, expires_at, rcode=None, raw=None):
+        self._rrs = rrs  # the RRset, or the SOA record for negative entries
+        self.raw = raw  # packed RRs not decoded yet, e.g. a slice of the mapped snapshot
+        self.expires_at = expires_at
+        self.rcode = rcode  # None for positive entries, NOERROR (NODATA) or NXDOMAIN for negative ones
+        self.hits = 0
+
+    @property
+    def rrs(self):
+        if self._rrs is None:
+            self._rrs = DNSRecord.parse(bytes(self.raw)).rr
+            self.raw = None
+        return self._rrs
+
+    @property
+    def negative(self):
+        return self.rcode is not None
+
+    def pack(self):
+        raw = self.raw  # read once: a snapshot is packed in a worker thread while the loop may parse the entry
+        return bytes(raw) if raw is not None else bytes(DNSRecord(rr=self._rrs).pack())
+
+
+class WireAnswer:
+    __slots__ = ('template', 'q_type', 'links')
+
+    def __init__(self, template, q_type, links):
+        self.template = template  # packed reply
+        self.q_type = q_type
+        self.links = links  # (key, entry, TTL offsets in template) for every cached RRset in the reply
+
+
+def question_key(package):
+    """Returns the question section of a plain single-question query with the name lowercased, else None."""
+    if len(package) < 17 or package[2] & 0xF8:
+        return
+    return question_section(package)
+
+
+def question_section(package):
+    """Returns the question section of a single-question message with the name lowercased, else None."""
+    if len(package) < 17 or package[4:6] != b'\x00\x01':
+        return
+    end = 12
+    while end < len(package) and 0 < package[end] < 0x40:
+        end += package[end] + 1
+    if end + 5 > len(package) or package[end] != 0:
+        return
+    return bytes(package[12:end]).lower() + bytes(package[end:end + 5])
+
+
+def skip_name(packet, offset):
+    while packet[offset] != 0:
+        if packet[offset] >= 0xC0:
+            return offset + 2
+        offset += packet[offset] + 1
+    return offset + 1
+
+
+def ttl_offsets(packet):
+    """Offsets of the TTL fields of all RRs in a packed message, in section order."""
+    questions, *counts = struct.unpack_from('!4H', packet, 4)
+    offset = 12
+    for _ in range(questions):
+        offset = skip_name(packet, offset) + 4
+    offsets = []
+    for _ in range(sum(counts)):
+        offset = skip_name(packet, offset)
+        offsets.append(offset + 4)
+        offset += 10 + struct.unpack_from('!H', packet, offset + 8)[0]
+    return offsets
 
 
 class Cache:
-    TIME_CACHE_CLEANED = time.time()
+    def __init__(self, max_entries=MAX_CACHE_ENTRIES, serve_stale=SERVE_STALE):
+        self.max_entries = max_entries
+        self.stale_window = MAX_STALE if serve_stale else 0
+        self.prefetch = None  # callback (q_type, name) that refreshes an entry in the background
+        self.cache = OrderedDict()  # (q_type, name) -> Entry, least recently used first
+        self.expiry = []  # min-heap of (expires_at, (q_type, name)), may hold outdated items
+        self.stats = dict.fromkeys(('hits', 'misses', 'evictions', 'expirations', 'prefetches', 'stale'), 0)
+        self.wire = OrderedDict()  # question section -> WireAnswer, least recently used first
+        self.file_name = None
+        self.snapshot = None  # read-only mmap of the snapshot, lazy entries point into it
+        self.journal = None
+        self.pending = []  # journal records not written yet
+        self.compaction = None  # task writing a new snapshot in a worker thread
 
-    def __init__(self):
-        self.cache = {}
-        for record_type in qtype_to_int.keys():
-            self.cache[record_type] = {}
+    def get_wire(self, package: bytes):
+        """Answers a hit straight from a packed template: patches ID, flags, question case and TTLs."""
+        question = question_key(package)
+        wire = self.wire.get(question)
+        if wire is None:
+            return
+        now = time.time()
+        response = bytearray(wire.template)
+        for key, entry, offsets in wire.links:
+            # a link that was replaced, evicted or expired sends the query down the full path
+            if self.cache.get(key) is not entry or entry.expires_at + self.stale_window <= now:
+                del self.wire[question]
+                return
+            self.cache.move_to_end(key)
+            ttl = struct.pack('!I', self.track(entry, wire.q_type, key[1], now))
+            for offset in offsets:
+                response[offset:offset + 4] = ttl
+        self.wire.move_to_end(question)
+        response[0:2] = package[0:2]
+        response[2] = response[2] & ~RECURSION_DESIRED | package[2] & RECURSION_DESIRED
+        response[3] = response[3] & ~CHECKING_DISABLED | package[3] & CHECKING_DISABLED
+        response[12:12 + len(question)] = package[12:12 + len(question)]
+        self.stats['hits'] += 1
+        return bytes(response)
 
-    def get_if_exist(self, parsed_packet):
-        record_name = str(parsed_packet.q.qname)
+    def get_if_exist(self, parsed_packet, package=None):
+        now = time.time()
         q_type = parsed_packet.q.qtype
-        if q_type not in self.cache or record_name not in self.cache[q_type]:
+        name = str(parsed_packet.q.qname).lower()
+        reply = parsed_packet.reply(aa=0)
+        links = []
+        for _ in range(MAX_CNAME_CHAIN):
+            for key in ((q_type, name), (QTYPE.CNAME, name), (NXDOMAIN_TYPE, name)):
+                if key[0] == QTYPE.CNAME == q_type:
+                    continue
+                entry = self.get_entry(key, now)
+                if entry is not None:
+                    break
+            if entry is None:
+                break
+            links.append((key, entry, len(entry.rrs)))
+            ttl = self.track(entry, q_type, name, now)
+            if entry.negative:
+                reply.header.rcode = entry.rcode
+                reply.add_auth(*self.with_ttl(entry.rrs, ttl))
+                return self.hit(reply, links, package)
+            reply.add_answer(*self.with_ttl(entry.rrs, ttl))
+            if entry.rrs[0].rtype != QTYPE.CNAME or q_type == QTYPE.CNAME:
+                return self.hit(reply, links, package)
+            name = str(entry.rrs[0].rdata).lower()
+        self.stats['misses'] += 1
+
+    def knows(self, q_type, name):
+        return any(key in self.cache for key in ((q_type, name), (QTYPE.CNAME, name), (NXDOMAIN_TYPE, name)))
+
+    def get_entry(self, key, now):
+        entry = self.cache.get(key)
+        if entry is None:
             return
-        reply = parsed_packet.reply()
-        reply.add_answer(self.get_pr_record(q_type, record_name))
-        return reply.pack()
+        if entry.expires_at + self.stale_window <= now:
+            self.expire(key)
+            return
+        self.cache.move_to_end(key)
+        return entry
+
+    def track(self, entry, q_type, name, now):
+        """Counts a hit on the entry, schedules its refresh if needed and returns the TTL to answer with."""
+        entry.hits += 1
+        if entry.expires_at <= now:
+            self.stats['stale'] += 1
+            self.refresh(q_type, name)
+            return STALE_TTL
+        ttl = int(entry.expires_at - now)
+        if entry.hits >= PREFETCH_HITS and not entry.negative and \
+                ttl < PREFETCH_WINDOW * min(rr.ttl for rr in entry.rrs):
+            self.refresh(q_type, name)
+        return ttl
+
+    def refresh(self, q_type, name):
+        if self.prefetch is not None and self.prefetch(q_type, name):
+            self.stats['prefetches'] += 1
+
+    def hit(self, reply, links, package=None):
+        self.stats['hits'] += 1
+        response = reply.pack()
+        question = question_key(package) if package is not None else None
+        if question is not None:
+            offsets = ttl_offsets(response)
+            wire_links = []
+            for key, entry, count in links:
+                wire_links.append((key, entry, offsets[:count]))
+                offsets = offsets[count:]
+            self.wire[question] = WireAnswer(bytes(response), reply.q.qtype, wire_links)
+            while len(self.wire) > self.max_entries:
+                self.wire.popitem(last=False)
+        return response
+
+    @staticmethod
+    def with_ttl(rrs, ttl):
+        return [RR(rr.rname, rr.rtype, rr.rclass, ttl, rr.rdata) for rr in rrs]
+
+    def add_response(self, response, zone='.'):
+        """
+        Caches a reply from a nameserver of the zone. Only records it is authoritative for are kept:
+        answers along the CNAME chain of the question while it stays in the zone, authority and
+        additional records at or below the zone.
+        """
+        rcode = response.header.rcode
+        if rcode not in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            return
+        chain = self.chain(response)
+        trusted = set()
+        for name in chain:
+            if not in_zone(name, zone):  # whatever the chain leads to outside the zone is not this server's
+                break
+            trusted.add(name)
+        self.add_records([rr for rr in response.rr if str(rr.rname).lower() in trusted] +
+                         [rr for rr in response.auth + response.ar if in_zone(str(rr.rname).lower(), zone)])
+        name = chain[-1]
+        if response.q.qtype == QTYPE.CNAME or name not in trusted:
+            return
+        if rcode == RCODE.NOERROR and any(str(rr.rname).lower() == name for rr in response.rr):
+            return
+        # RFC 2308: negative answers are cached for min(SOA TTL, SOA MINIMUM)
+        soa = next((rr for rr in response.auth if rr.rtype == QTYPE.SOA), None)
+        if soa is None:
+            return
+        ttl = min(soa.ttl, soa.rdata.times[-1])
+        key = (NXDOMAIN_TYPE if rcode == RCODE.NXDOMAIN else response.q.qtype, name)
+        self.store(key, Entry([soa], time.time() + ttl, rcode))
 
-    def get_pr_record(self, q_type, body):
-        return RR(body, qtype_to_int[q_type][0], rdata=qtype_to_int[q_type][1](self.cache[q_type][body][0]), ttl=60)
+    @staticmethod
+    def chain(response):
+        """The question name and the names its CNAME records in the answer lead to, in order."""
+        names = [str(response.q.qname).lower()]
+        targets = {str(rr.rname).lower(): str(rr.rdata).lower() for rr in response.rr if rr.rtype == QTYPE.CNAME}
+        for _ in range(MAX_CNAME_CHAIN):
+            if names[-1] not in targets or targets[names[-1]] in names:
+                break
+            names.append(targets[names[-1]])
+        return names
 
     def add_records(self, records):
+        rrsets = {}
         for record in records:
-            self.cache[record.rtype][str(record.rname)] = (str(record.rdata), time.time(), record.ttl)
+            if record.rtype == QTYPE.OPT:
+                continue
+            rrset = rrsets.setdefault((record.rtype, str(record.rname).lower()), [])
+            if all(rr.rdata != record.rdata for rr in rrset):
+                rrset.append(record)
+        now = time.time()
+        for key, rrs in rrsets.items():
+            self.store(key, Entry(rrs, now + min(rr.ttl for rr in rrs)))
 
-    def remove_expired_records(self):
-        for q_type in self.cache:
-            for q_name in self.cache[q_type]:
-                time_record_created = self.cache[q_type][q_name][1]
-                ttl = self.cache[q_type][q_name][2]
-                if time.time() - time_record_created > ttl:
-                    del self.cache[q_type][q_name]
-        self.TIME_CACHE_CLEANED = time.time()
+    def store(self, key, entry):
+        self.insert(key, entry)
+        if self.journal is not None:
+            self.pending.append(self.encode(INSERT, key, entry))
 
-    def save_cache(self, cache_file_name):
-        with open(cache_file_name, 'wb+') as dump:
-            pickle.dump(self, dump)
+    def insert(self, key, entry):
+        previous = self.cache.get(key)
+        if previous is not None:
+            # popularity survives a refresh, halved so cold names stop being prefetched
+            entry.hits = previous.hits // 2
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        heapq.heappush(self.expiry, (entry.expires_at, key))
+        while len(self.cache) > self.max_entries:
+            evicted, _ = self.cache.popitem(last=False)
+            self.stats['evictions'] += 1
+            if self.journal is not None:
+                self.pending.append(self.encode(DELETE, evicted))
+        if len(self.expiry) > 2 * len(self.cache) + 64:
+            self.expiry = [(entry.expires_at, key) for key, entry in self.cache.items()]
+            heapq.heapify(self.expiry)
+
+    def expire(self, key):
+        del self.cache[key]
+        self.stats['expirations'] += 1
+
+    def remove_expired_records(self, now=None):
+        now = time.time() if now is None else now
+        while self.expiry and self.expiry[0][0] + self.stale_window <= now:
+            expires_at, key = heapq.heappop(self.expiry)
+            entry = self.cache.get(key)
+            # heap items left behind by overwritten or evicted records are skipped
+            if entry is not None and entry.expires_at == expires_at:
+                self.expire(key)
 
     @staticmethod
-    def load_cache(cache_file_name):
+    def encode(op, key, entry=None):
+        name = key[1].encode()
+        if entry is None:
+            return RECORD.pack(op, 0, key[0], 0, len(name), 0) + name
+        payload = entry.pack()
+        rcode = POSITIVE if entry.rcode is None else entry.rcode
+        return RECORD.pack(op, entry.expires_at, key[0], rcode, len(name), len(payload)) + name + payload
+
+    def replay(self, buffer, offset, now):
+        """Loads records from a snapshot or journal buffer, returns the offset after the last whole record."""
+        while offset + RECORD.size <= len(buffer):
+            op, expires_at, q_type, rcode, name_length, size = RECORD.unpack_from(buffer, offset)
+            start = offset + RECORD.size + name_length
+            if start + size > len(buffer):
+                break
+            key = (q_type, bytes(buffer[offset + RECORD.size:start]).decode())
+            offset = start + size
+            if op == INSERT and expires_at + self.stale_window > now:
+                raw = buffer[start:offset]
+                self.insert(key, Entry(None, expires_at, None if rcode == POSITIVE else rcode, raw))
+            else:
+                self.cache.pop(key, None)
+        return offset
+
+    def attach(self, file_name):
+        self.file_name = file_name
+        now = time.time()
         try:
-            with open(cache_file_name, 'rb') as dump:
-                cache = pickle.load(dump)
-            print('Cache loaded')
-            return cache
+            with open(file_name, 'rb') as f:
+                if f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                    self.snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.replay(memoryview(self.snapshot), len(SNAPSHOT_MAGIC), now)
+                    print('Cache loaded')
+                else:
+                    print('Cache has outdated format')
         except FileNotFoundError:
             print('Cache does not exist')
-            return Cache()
+        data, end = self.replay_file(file_name + JOURNAL_SUFFIX, now)
+        # a compaction was interrupted: its journal holds the records that came after the old one
+        next_data, next_end = self.replay_file(file_name + NEXT_JOURNAL_SUFFIX, now)
+        self.journal = open(file_name + JOURNAL_SUFFIX, 'ab')
+        if end < len(data):  # drop a record torn by a crash
+            self.journal.truncate(end)
+        if next_data:
+            self.append(self.journal, next_data[:next_end])
+            os.remove(file_name + NEXT_JOURNAL_SUFFIX)
+
+    def replay_file(self, file_name, now):
+        try:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        return data, self.replay(data, 0, now)
+
+    @staticmethod
+    def append(journal, data):
+        """Runs in a worker thread: the write and fsync would stall every query on the event loop."""
+        journal.write(data)
+        journal.flush()
+        os.fsync(journal.fileno())
+        return journal.tell()
+
+    async def flush(self):
+        """Writes the pending records to the journal and starts a compaction once it outgrows the snapshot."""
+        if self.journal is None or not self.pending:
+            return
+        data = b''.join(self.pending)
+        self.pending.clear()
+        size = await asyncio.get_running_loop().run_in_executor(None, self.append, self.journal, data)
+        if size > COMPACT_JOURNAL_SIZE and size > len(self.snapshot or b'') and self.compaction is None:
+            self.compaction = asyncio.ensure_future(self.compact())
+
+    async def compact(self):
+        """
+        Writes a new snapshot from a copy of the entries in a worker thread. Records journaled meanwhile
+        go to a new journal, which replaces the old one together with the snapshot.
+        """
+        try:
+            entries = self.rotate()
+            temp_file_name = self.file_name + '.tmp'
+            lazy = await asyncio.get_running_loop().run_in_executor(
+                None, self.write_snapshot, temp_file_name, entries)
+            self.install(temp_file_name, lazy)
+        finally:
+            self.compaction = None
+
+    async def close(self):
+        """Waits for a running compaction and writes the final snapshot, also off the event loop."""
+        if self.compaction is not None:
+            await self.compaction
+        if self.journal is not None:
+            await self.flush()
+            if self.compaction is None:  # flush may have started one already
+                self.compaction = asyncio.ensure_future(self.compact())
+            await self.compaction
+
+    def rotate(self):
+        """
+        Takes the entries for a new snapshot and switches to the next journal. Entries are never changed
+        in place, only replaced, so a copy of the list is enough.
+        """
+        self.remove_expired_records()
+        entries = list(self.cache.items())
+        self.journal.close()
+        self.journal = open(self.file_name + NEXT_JOURNAL_SUFFIX, 'wb')
+        return entries
+
+    @classmethod
+    def write_snapshot(cls, file_name, entries):
+        """
+        Writes the entries, fsyncs the file and returns where the payloads of lazy entries ended up:
+        (key, entry, offset, size).
+        """
+        lazy = []
+        with open(file_name, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            for key, entry in entries:
+                raw = entry.raw
+                record = cls.encode(INSERT, key, entry)
+                if raw is not None:
+                    lazy.append((key, entry, f.tell() + len(record) - len(raw), len(raw)))
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        return lazy
+
+    def install(self, temp_file_name, lazy):
+        """Replaces the snapshot and the journal and moves lazy entries from the old mapping to the new one."""
+        # entries still lazy are moved, so the old mapping can be closed before replacing the file
+        moved = [(entry, offset, size) for key, entry, offset, size in lazy
+                 if entry.raw is not None and self.cache.get(key) is entry]
+        for _, entry, _, _ in lazy:
+            entry.raw = None
+        if self.snapshot is not None:
+            try:
+                self.snapshot.close()
+            except BufferError:  # a replaced entry is still held by a packed answer, unmapped when it goes
+                pass
+            self.snapshot = None
+        os.replace(temp_file_name, self.file_name)
+        os.replace(self.file_name + NEXT_JOURNAL_SUFFIX, self.file_name + JOURNAL_SUFFIX)
+        with open(self.file_name, 'rb') as f:
+            self.snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.snapshot)
+        for entry, offset, size in moved:
+            entry.raw = view[offset:offset + size]
+
+    def save_cache(self, cache_file_name):
+        """Writes a snapshot right away, blocking; the server uses compact() and close() instead."""
+        if cache_file_name != self.file_name or self.journal is None:
+            self.remove_expired_records()
+            entries = list(self.cache.items())
+            self.write_snapshot(cache_file_name + '.tmp', entries)
+            os.replace(cache_file_name + '.tmp', cache_file_name)
+            return
+        entries = self.rotate()
+        lazy = self.write_snapshot(cache_file_name + '.tmp', entries)
+        self.install(cache_file_name + '.tmp', lazy)
+
+    @staticmethod
+    def load_cache(cache_file_name):
+        cache = Cache()
+        cache.attach(cache_file_name)
+        return cache
+
+
+def parent_zone(zone):
+    return (zone.split('.', 1)[1] or '.') if zone != '.' else None
+
+
+def in_zone(name, zone):
+    return zone == '.' or name == zone or name.endswith('.' + zone)
+
+
+class Delegation:
+    __slots__ = ('names', 'addresses', 'expires_at')
+
+    def __init__(self, names, addresses, expires_at):
+        self.names = names  # nameserver host names
+        self.addresses = addresses  # glue or resolved IPv4 addresses of the nameservers
+        self.expires_at = expires_at
+
+
+class Delegations:
+    """Zone cuts learned from referrals, so resolution starts at the closest known nameservers."""
+
+    def __init__(self, max_zones=MAX_CACHE_ENTRIES):
+        self.max_zones = max_zones
+        self.zones = OrderedDict()  # zone -> Delegation, least recently used first
+        self.pending = {}  # zone -> task looking up addresses of glue-less nameservers
+
+    def get(self, zone):
+        delegation = self.zones.get(zone)
+        if delegation is None:
+            return
+        if delegation.expires_at <= time.time():
+            del self.zones[zone]
+            return
+        self.zones.move_to_end(zone)
+        return delegation
+
+    def closest(self, name):
+        while name is not None:
+            if self.get(name) is not None:
+                return name
+            name = parent_zone(name)
+
+    def add_referral(self, response, zone, name):
+        """Stores the delegation from a referral answer and returns its zone, None for a bogus referral."""
+        ns_records = [rr for rr in response.auth if rr.rtype == QTYPE.NS]
+        if not ns_records:
+            return
+        child = str(ns_records[0].rname).lower()
+        # only a step down from the zone that was asked and towards the name is followed
+        if child == zone or not in_zone(child, zone) or not in_zone(name, child):
+            return
+        ns_records = [rr for rr in ns_records if str(rr.rname).lower() == child]
+        names = [str(rr.rdata).lower() for rr in ns_records]
+        # glue is only taken for nameservers inside the delegated zone, anything else could point anywhere
+        glue = [rr for rr in response.ar if rr.rtype == QTYPE.A and str(rr.rname).lower() in names and
+                in_zone(str(rr.rname).lower(), child)]
+        ttl = min(rr.ttl for rr in ns_records + glue)
+        self.zones[child] = Delegation(names, [str(rr.rdata) for rr in glue], time.time() + ttl)
+        self.zones.move_to_end(child)
+        while len(self.zones) > self.max_zones:
+            self.zones.popitem(last=False)
+        return child
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        self.server.spawn(self.server.answer(data, address))
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def datagram_received(self, data, address):
+        pending = self.pool.pending.get((address[0], address[1], data[:2]))
+        if pending is None:
+            return
+        future, question = pending
+        # a spoofed answer has to guess the question as well as the ID and the port
+        if not future.done() and question_section(data) == question:
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass  # errors on a shared socket can't be matched to a query, it just times out
+
+
+class TCPConnection:
+    """Persistent pipelined connection to one upstream, answers are matched by transaction ID (RFC 7766)."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.reading = asyncio.create_task(self.read())
+
+    @property
+    def closed(self):
+        return self.reading.done()
+
+    async def read(self):
+        try:
+            while True:
+                size, = struct.unpack('!H', await self.reader.readexactly(2))
+                data = await self.reader.readexactly(size)
+                future = self.pending.get(data[:2])
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError())
+
+    async def query(self, package: bytes) -> bytes:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[package[:2]] = future
+        try:
+            self.writer.write(struct.pack('!H', len(package)) + package)
+            return await asyncio.wait_for(future, UPSTREAM_TIMEOUT)
+        finally:
+            self.pending.pop(package[:2], None)
+
+    def close(self):
+        self.reading.cancel()
+
+
+class UpstreamPool:
+    def __init__(self, size=UPSTREAM_SOCKETS, metrics=None):
+        self.size = size
+        metrics = metrics or Metrics('upstream')
+        self.queries = metrics.counter('upstream.queries')
+        self.timeouts = metrics.counter('upstream.timeouts')
+        self.tcp_queries = metrics.counter('upstream.tcp_queries')
+        self.rtt = metrics.histogram('upstream.rtt')
+        self.transports = []
+        self.renew_at = []  # monotonic time to replace each socket
+        self.retiring = set()  # replaced sockets waiting for late answers
+        self.pending = {}  # (ip, port, transaction ID) -> (future of the UDP answer, question_section of the query)
+        self.connections = {}  # (ip, port) -> TCPConnection or the task opening it
+        self.next = 0
+
+    async def open(self):
+        for _ in range(self.size):
+            self.transports.append(await self.open_socket())
+            self.renew_at.append(time.monotonic() + UPSTREAM_SOCKET_LIFETIME)
+
+    async def open_socket(self):
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: UpstreamProtocol(self), local_addr=('0.0.0.0', 0))
+        return transport
+
+    async def renew(self, index):
+        """Moves a socket to a new random port, the old one stays open for the answers still on the way."""
+        self.renew_at[index] = time.monotonic() + UPSTREAM_SOCKET_LIFETIME
+        transport = await self.open_socket()
+        old, self.transports[index] = self.transports[index], transport
+        self.retiring.add(old)
+        asyncio.get_running_loop().call_later(UPSTREAM_TIMEOUT, self.retire, old)
+
+    def retire(self, transport):
+        self.retiring.discard(transport)
+        transport.close()
+
+    def close(self):
+        for transport in self.transports + list(self.retiring):
+            transport.close()
+        for connection in self.connections.values():
+            connection.close() if isinstance(connection, TCPConnection) else connection.cancel()
+
+    async def query(self, package: bytes, ip, port) -> bytes:
+        """Sends a query over a pooled UDP socket under a fresh random ID, retries over TCP if truncated."""
+        while True:
+            query_id = struct.pack('!H', random.getrandbits(16))
+            if (ip, port, query_id) not in self.pending:
+                break
+        self.next = index = (self.next + 1) % self.size
+        if time.monotonic() >= self.renew_at[index]:
+            await self.renew(index)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[ip, port, query_id] = (future, question_section(package))
+        self.queries.inc()
+        started = time.perf_counter()
+        try:
+            self.transports[index].sendto(query_id + package[2:], (ip, port))
+            response = await asyncio.wait_for(future, UPSTREAM_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timeouts.inc()
+            raise
+        finally:
+            del self.pending[ip, port, query_id]
+        self.rtt.record(time.perf_counter() - started)
+        if response[2] & TRUNCATED:
+            self.tcp_queries.inc()
+            connection = await self.connection(ip, port)
+            while True:
+                query_id = struct.pack('!H', random.getrandbits(16))
+                if query_id not in connection.pending:
+                    break
+            response = await connection.query(query_id + package[2:])
+        return package[:2] + response[2:]
+
+    async def connection(self, ip, port) -> TCPConnection:
+        connection = self.connections.get((ip, port))
+        if isinstance(connection, TCPConnection) and not connection.closed:
+            return connection
+        if not isinstance(connection, asyncio.Task):
+            # concurrent truncated answers wait for the same connect
+            connection = asyncio.create_task(self.connect(ip, port))
+            self.connections[ip, port] = connection
+        try:
+            return await asyncio.shield(connection)
+        except OSError:
+            self.connections.pop((ip, port), None)
+            raise
+
+    async def connect(self, ip, port) -> TCPConnection:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), UPSTREAM_TIMEOUT)
+        connection = TCPConnection(reader, writer)
+        self.connections[ip, port] = connection
+        return connection
 
 
 class Server:
-    def __init__(self, cache, host_ip="localhost", port=53):
-        self.server = socket(AF_INET, SOCK_DGRAM)
-        self.server.settimeout(2)
-        self.server.bind((host_ip, port))
+    def __init__(self, cache, host_ip="localhost", port=53, root_server=ROOT_SERVER, upstream_port=UPSTREAM_PORT,
+                 metrics=None):
+        self.address = (host_ip, port)
+        self.root_server = root_server
+        self.upstream_port = upstream_port
         self.cache = cache
+        self.cache.prefetch = self.prefetch
+        self.transport = None
+        self.tcp_server = None
+        self.metrics = metrics or Metrics('dns')
+        self.upstream = UpstreamPool(metrics=self.metrics)
+        self.delegations = Delegations()
+        self.in_flight = {}
+        self.tasks = set()
+        self.udp_requests = self.metrics.counter('requests.udp')
+        self.tcp_requests = self.metrics.counter('requests.tcp')
+        self.malformed = self.metrics.counter('requests.malformed')
+        self.errors = self.metrics.counter('requests.errors')
+        self.truncated = self.metrics.counter('responses.truncated')
+        self.failures = self.metrics.counter('responses.servfail')
+        self.resolutions = self.metrics.counter('lookups.resolved')
+        self.coalesced = self.metrics.counter('lookups.coalesced')
+        self.response_time = self.metrics.histogram('response')
+        for name in self.cache.stats:
+            self.metrics.gauge(f'cache.{name}', lambda name=name: self.cache.stats[name])
+        self.metrics.gauge('cache.entries', lambda: len(self.cache.cache))
+        self.metrics.gauge('lookups.in_flight', lambda: len(self.in_flight))
 
     def start(self):
-        while True:
-            data, address = self.get_packet()
-            response = self.handle_packet(data)
-            self.clear_cache_if_need(time.time())
-            self.server.sendto(response, address)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        await self.upstream.open()  # before listening, a query arriving earlier would find no upstream sockets
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), local_addr=self.address)
+        self.transport.get_extra_info('socket').setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER)
+        self.tcp_server = await asyncio.start_server(self.serve_tcp_client, *self.address)
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL)
+                self.cache.remove_expired_records()
+                await self.cache.flush()
+        finally:
+            self.transport.close()
+            self.tcp_server.close()
+            # answers still resolving would outlive the sockets while the cache is being saved
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.upstream.close()
+            await self.cache.close()
 
-    def clear_cache_if_need(self, time_now):
-        if time_now - self.cache.TIME_CACHE_CLEANED > 30:
-            self.cache.remove_expired_records()
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def answer(self, data, address):
+        started = time.perf_counter()
+        self.udp_requests.inc()
+        response = await self.respond(data)
+        if response and self.transport is not None and not self.transport.is_closing():
+            if len(response) > UDP_PAYLOAD:
+                response = self.truncate(data, response)
+                if response[2] & TRUNCATED:
+                    self.truncated.inc()
+            self.transport.sendto(response, address)
+            self.response_time.record(time.perf_counter() - started)
+
+    @staticmethod
+    def truncate(query: bytes, response: bytes) -> bytes:
+        """Replaces an answer too large for the client's UDP buffer by an empty one with TC set."""
+        parsed_query = DNSRecord.parse(query)
+        limit = max([UDP_PAYLOAD] + [rr.rclass for rr in parsed_query.ar if rr.rtype == QTYPE.OPT])
+        if len(response) <= limit:
+            return response
+        reply = parsed_query.reply(aa=0)
+        reply.header.tc = 1
+        return reply.pack()
 
-    def get_packet(self):
+    async def serve_tcp_client(self, reader, writer):
         try:
-            return self.server.recvfrom(256)
-        except timeout:
-            return self.get_packet()
-        except Exception as e:
-            self.server.close()
-            print(e)
-            exit()
-
-    def handle_packet(self, package: bytes) -> bytes:
-        ip = ROOT_SERVER
-        byte_response = None
-        response = None
-        while response is None or len(response.rr) == 0:
-            parsed_packet = DNSRecord.parse(package)
-            cache_record = self.cache.get_if_exist(parsed_packet)
-            if cache_record:
-                return cache_record
+            while True:
+                size, = struct.unpack('!H', await reader.readexactly(2))
+                self.spawn(self.answer_tcp(await reader.readexactly(size), writer))
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer_tcp(self, data, writer):
+        started = time.perf_counter()
+        self.tcp_requests.inc()
+        response = await self.respond(data)
+        if response and not writer.is_closing():
+            writer.write(struct.pack('!H', len(response)) + response)
+            self.response_time.record(time.perf_counter() - started)
+
+    async def respond(self, data):
+        """Answer to a client query: nothing for a malformed one, SERVFAIL if resolving it failed unexpectedly."""
+        try:
+            return await self.handle_packet(data)
+        except DNSError:
+            self.malformed.inc()
+        except Exception:
+            self.errors.inc()
+            try:
+                return self.server_failure(DNSRecord.parse(data))
+            except DNSError:
+                return None
+
+    async def handle_packet(self, package: bytes) -> bytes:
+        cache_record = self.cache.get_wire(package)
+        if cache_record:
+            return cache_record
+        parsed_packet = DNSRecord.parse(package)
+        cache_record = self.cache.get_if_exist(parsed_packet, package)
+        if cache_record:
+            return cache_record
+        # identical misses share one upstream lookup; only the ID differs
+        response = await asyncio.shield(self.lookup(parsed_packet))
+        return package[:2] + response[2:]
+
+    def lookup(self, parsed_packet):
+        key = (str(parsed_packet.q.qname).lower(), parsed_packet.q.qtype)
+        lookup = self.in_flight.get(key)
+        if lookup is None:
+            self.resolutions.inc()
+            lookup = self.spawn(self.resolve(parsed_packet))
+            self.in_flight[key] = lookup
+            lookup.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced.inc()
+        return lookup
+
+    def prefetch(self, q_type, name):
+        if (name, q_type) in self.in_flight:
+            return False
+        self.lookup(DNSRecord(q=DNSQuestion(name, q_type)))
+        return True
+
+    async def resolve(self, parsed_packet) -> bytes:
+        name = str(parsed_packet.q.qname).lower()
+        zone, addresses = await self.closest_servers(name)
+        attempts = 0
+        for _ in range(MAX_REFERRALS):
             try:
-                byte_response = parsed_packet.send(ip, timeout=4)
-            except timeout:
-                ip = ROOT_SERVER
+                byte_response = await self.upstream.query(parsed_packet.pack(), addresses[attempts % len(addresses)],
+                                                          self.upstream_port)
+            except (asyncio.TimeoutError, OSError):
+                attempts += 1
+                if attempts >= UPSTREAM_ATTEMPTS:
+                    return self.server_failure(parsed_packet)
+                if attempts >= len(addresses):
+                    zone, addresses = '.', [self.root_server]
                 continue
             response = DNSRecord.parse(byte_response)
-            if response.header.rcode == 3:
+            referral = None
+            if response.header.rcode == RCODE.NOERROR and not response.rr and \
+                    not any(rr.rtype == QTYPE.SOA for rr in response.auth):
+                referral = self.delegations.add_referral(response, zone, name)
+            # a referral is trusted only for the zone it delegates
+            self.cache.add_response(response, referral or zone)
+            if referral is None:
+                self.follow_chain(response, zone)
                 return byte_response
-            self.cache.add_records(response.ar)
-            ip = next((str(x.rdata) for x in response.ar if x.rtype == 1), -1)
-            if ip == -1 and len(response.rr) == 0:
-                resp = self.handle_packet(DNSRecord.question(str(response.auth[0].rdata)).pack())
-                ip = str(DNSRecord.parse(resp).rr[0].rdata)
-        self.cache.add_records(response.rr)
-        return byte_response
+            zone = referral
+            addresses = await self.zone_addresses(zone, name)
+            if not addresses:
+                return self.server_failure(parsed_packet)
+        return self.server_failure(parsed_packet)
+
+    def follow_chain(self, response, zone):
+        """The part of a CNAME chain outside the zone is not cached from this answer, it is resolved on its own."""
+        q_type = response.q.qtype
+        outside = next((name for name in self.cache.chain(response) if not in_zone(name, zone)), None)
+        if outside is not None and q_type != QTYPE.CNAME and not self.cache.knows(q_type, outside):
+            self.prefetch(q_type, outside)
+
+    async def closest_servers(self, name):
+        """Finds the deepest cached zone cut above the name that has reachable nameservers."""
+        zone = self.delegations.closest(name)
+        while zone is not None:
+            addresses = await self.zone_addresses(zone, name)
+            if addresses:
+                return zone, addresses
+            zone = self.delegations.closest(parent_zone(zone))
+        return '.', [self.root_server]
+
+    async def zone_addresses(self, zone, name):
+        delegation = self.delegations.get(zone)
+        if delegation is None:
+            return []
+        if delegation.addresses:
+            return delegation.addresses
+        lookup = self.delegations.pending.get(zone)
+        if lookup is None:
+            # concurrent resolutions below a glue-less zone cut share one nameserver lookup
+            lookup = self.spawn(self.nameserver_addresses(delegation, zone, name))
+            self.delegations.pending[zone] = lookup
+            lookup.add_done_callback(lambda _: self.delegations.pending.pop(zone, None))
+        try:
+            return await asyncio.wait_for(asyncio.shield(lookup), UPSTREAM_TIMEOUT * UPSTREAM_ATTEMPTS)
+        except asyncio.TimeoutError:
+            return []
+
+    async def nameserver_addresses(self, delegation, zone, name):
+        for ns_name in delegation.names:
+            if in_zone(ns_name, zone) or in_zone(ns_name, name):
+                continue  # such a nameserver can't be found without glue
+            response = DNSRecord.parse(await self.handle_packet(DNSRecord.question(ns_name).pack()))
+            addresses = [str(rr.rdata) for rr in response.rr if rr.rtype == QTYPE.A]
+            if addresses:
+                delegation.addresses = addresses
+                return addresses
+        return []
+
+    def server_failure(self, parsed_packet) -> bytes:
+        self.failures.inc()
+        reply = parsed_packet.reply()
+        reply.header.rcode = RCODE.SERVFAIL
+        return reply.pack()
 
 
 def main():
-    cache = Cache.load_cache(CACHE_FILE)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost', help='address to listen on')
+    parser.add_argument('--port', type=int, default=53)
+    parser.add_argument('--upstream', default=ROOT_SERVER, help='server to start resolution at')
+    parser.add_argument('--upstream-port', type=int, default=UPSTREAM_PORT)
+    parser.add_argument('--cache', default=CACHE_FILE, help='snapshot file, the journal is kept next to it')
+    parser.add_argument('--max-entries', type=int, default=MAX_CACHE_ENTRIES)
+    parser.add_argument('--serve-stale', action='store_true', default=SERVE_STALE)
+    add_arguments(parser)
+    args = parser.parse_args()
+    cache = Cache(args.max_entries, args.serve_stale)
+    cache.attach(args.cache)
+    metrics = Metrics('dns')
+    reporter = Reporter(metrics, **options(args)).start()
     try:
-        Server(cache).start()
+        Server(cache, args.host, args.port, args.upstream, args.upstream_port, metrics).start()
     except (KeyboardInterrupt, SystemExit):
-        print('Exit. Cache saved.')
-        cache.save_cache(CACHE_FILE)
+        print('Exit. Cache saved.')  # by Server.serve on the way out
+    finally:
+        reporter.close()
 
 
 if __name__ == '__main__':
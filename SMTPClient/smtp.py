@@ -1,24 +1,622 @@
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import create_connection, IPPROTO_TCP, TCP_NODELAY
+from email.header import Header
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from urllib.parse import quote
+import argparse
+import heapq
+import json
+import queue
 import smtplib
 import base64
+import hashlib
+import mimetypes
+import os
+import quopri
+import secrets
 import sys
 import ssl
+import threading
+import time
+import traceback
 
 MAIL_SERVERS = {'yandex.ru': ('smtp.yandex.ru', 465),
                 'mail.ru': ('smtp.mail.ru', 465),
-                'rambler.ru': ('smtp.rambler.ru ', 465),
+                'rambler.ru': ('smtp.rambler.ru', 465),
                 'gmail.com': ('smtp.gmail.com', 465)}
+SMTP_TIMEOUT = 30
+MAX_LINE = 8192
+MAX_RECIPIENTS = 100  # RCPT TO в одной транзакции: больше 100 серверы обычно не принимают (RFC 5321, 4.5.3.1.8)
+ATTACHMENTS_DIR = 'files/attachments'
+ENCODED_DIR = 'files/encoded'
+CHUNK = 57 * 1024  # кратно 57 байтам: столько помещается в строку base64 из 76 символов
+SPOOL_FILE = 'files/spool'
+JOURNAL_SUFFIX = '.journal'
+COMPACT_JOURNAL_SIZE = 4 * 1024 * 1024
+SERVER_CONCURRENCY = 4  # сессий на один почтовый сервер
+SERVER_RATE = 0  # писем в секунду на один сервер, 0 - без ограничения
+MAX_ATTEMPTS = 8
+RETRY_DELAY = 2  # секунд до первого повтора, дальше вдвое больше с каждой попыткой
+FLUSH_INTERVAL = 0.1
+REPORT_INTERVAL = 1
+
+
+class SMTPError(Exception):
+    """
+    Отрицательный ответ сервера: код и строки ответа.
+    """
+
+    def __init__(self, code: int, lines: list[str]):
+        super().__init__(f'{code} {" ".join(lines)}')
+        self.code = code
+        self.lines = lines
+
+    @property
+    def temporary(self) -> bool:
+        return 400 <= self.code < 500
+
+
+def dot_stuff(lines):
+    """
+    Строки текста в вид для DATA по мере их появления: CRLF в конце, точка в начале строки удваивается.
+    """
+    for line in lines:
+        line = line.rstrip(b'\r\n')
+        yield (b'.' + line if line.startswith(b'.') else line) + b'\r\n'
+
+
+class AttachmentCache:
+    """
+    Вложения, уже закодированные в base64 (строки по 76 символов с CRLF), в файлах каталога directory
+    с именем по sha256 содержимого: одно и то же вложение кодируется один раз на всех получателей и все
+    запуски, а в письмо идёт готовый текст кусками по CHUNK.
+    """
+
+    def __init__(self, directory: str = ENCODED_DIR):
+        self._directory = directory
+        self._digests = {}  # (путь, размер, время изменения) -> sha256 содержимого
+        self._lock = threading.Lock()  # письма собираются и в нескольких потоках
+        self.encoded = 0
+
+    def path(self, source: str) -> str:
+        """
+        :return: путь к закодированному вложению, кодирует его при первом обращении
+        """
+        info = os.stat(source)
+        key = (source, info.st_size, info.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(source, 'rb') as f:
+                while block := f.read(CHUNK):
+                    sha256.update(block)
+            digest = self._digests[key] = sha256.hexdigest()
+        path = os.path.join(self._directory, digest + '.b64')
+        if not os.path.exists(path):
+            with self._lock:
+                if not os.path.exists(path):
+                    os.makedirs(self._directory, exist_ok=True)
+                    with open(source, 'rb') as f, open(path + '.tmp', 'wb') as encoded:
+                        while block := f.read(CHUNK):
+                            encoded.write(base64.encodebytes(block).replace(b'\n', b'\r\n'))
+                    os.replace(path + '.tmp', path)
+                    self.encoded += 1
+        return path
+
+
+class StreamingMessage:
+    """
+    Письмо multipart/mixed, которое не собирается в памяти: итерация выдаёт его куски уже в виде для DATA
+    (с CRLF, удвоенными точками и завершающей точкой). Текст - quoted-printable, вложения читаются кусками
+    из AttachmentCache, так что память не зависит от их размера. Итерировать можно повторно, например
+    при повторной отправке по новой сессии.
+    """
+
+    def __init__(self, sender: str, recipient: str, subject: str, text: str, attachments: list[str],
+                 cache: AttachmentCache):
+        """
+        :param attachments: пути к файлам вложений
+        """
+        self._sender = sender
+        self._recipient = recipient
+        self._subject = subject
+        self._text = text
+        self._attachments = attachments
+        self._cache = cache
+        self._boundary = '=' * 15 + secrets.token_hex(16)
+        self._date = formatdate(localtime=True)
+        self._id = make_msgid()  # при повторной отправке письмо то же самое
+
+    def __iter__(self):
+        headers = [f'From: {self._sender}', f'To: {self._recipient}',
+                   f'Subject: {Header(self._subject, "utf-8").encode()}', f'Date: {self._date}',
+                   f'Message-ID: {self._id}', 'MIME-Version: 1.0',
+                   f'Content-Type: multipart/mixed; boundary="{self._boundary}"', '',
+                   f'--{self._boundary}', 'Content-Type: text/plain; charset="utf-8"',
+                   'Content-Transfer-Encoding: quoted-printable', '']
+        yield ''.join(line + '\r\n' for line in headers).encode()
+        text = quopri.encodestring(self._text.replace('\r\n', '\n').encode()).splitlines()
+        yield b''.join(dot_stuff(text))
+        for attachment in self._attachments:
+            name = os.path.basename(attachment)
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            filename = f'filename="{name}"' if name.isascii() else f"filename*=utf-8''{quote(name)}"
+            yield (f'--{self._boundary}\r\nContent-Type: {content_type}\r\n'
+                   f'Content-Transfer-Encoding: base64\r\nContent-Disposition: attachment; {filename}\r\n\r\n'
+                   ).encode()
+            # в строках base64 нет точек, удваивать нечего
+            with open(self._cache.path(attachment), 'rb') as f:
+                while block := f.read(CHUNK):
+                    yield block
+        yield f'--{self._boundary}--\r\n.\r\n'.encode()
+
+
+class SMTPSession:
+    """
+    Одна сессия ESMTP: соединение, TLS и авторизация выполняются один раз, затем по ней уходит сколько угодно
+    писем. Если сервер объявил PIPELINING, MAIL FROM, все RCPT TO и DATA письма отправляются одной записью,
+    а ответы читаются потом по порядку. Ответы читаются целиком, включая многострочные («250-...»).
+    """
+
+    def __init__(self, server: tuple[str, int], tls: bool = None, name: str = 'localhost',
+                 timeout: float = SMTP_TIMEOUT):
+        """
+        :param server: (хост, порт) из MAIL_SERVERS
+        :param tls: TLS сразу при соединении; по умолчанию - для порта 465, на других портах STARTTLS,
+        если сервер его объявил
+        :param name: имя для EHLO
+        """
+        self._host = server[0]
+        self._sock = create_connection(server, timeout)
+        # команды и куски письма уходят сразу, не дожидаясь подтверждения прошлых (алгоритм Нейгла)
+        self._sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if tls is None:
+            tls = server[1] == 465
+        if tls:
+            self._sock = ssl.create_default_context().wrap_socket(self._sock, server_hostname=self._host)
+        self._file = self._sock.makefile('rb')
+        self.extensions = {}  # расширение ESMTP -> его параметры
+        self.expect(self.reply(), 220)
+        self.ehlo(name)
+        if not tls and 'STARTTLS' in self.extensions:
+            self.expect(self.command('STARTTLS'), 220)
+            self._sock = ssl.create_default_context().wrap_socket(self._sock, server_hostname=self._host)
+            self._file = self._sock.makefile('rb')
+            self.ehlo(name)
+        self.messages = 0
+
+    @property
+    def pipelining(self) -> bool:
+        return 'PIPELINING' in self.extensions
+
+    def ehlo(self, name: str):
+        _, lines = self.expect(self.command(f'EHLO {name}'), 250)
+        self.extensions = {}
+        for line in lines[1:]:
+            keyword, _, parameters = line.partition(' ')
+            self.extensions[keyword.upper()] = parameters
+
+    def login(self, user: str, password: str):
+        token = base64.b64encode(f'\0{user}\0{password}'.encode()).decode()
+        self.expect(self.command(f'AUTH PLAIN {token}'), 235)
+
+    def reply(self) -> tuple[int, list[str]]:
+        """
+        :return: код и строки ответа, многострочный ответ читается до строки без дефиса после кода
+        """
+        lines = []
+        while True:
+            line = self._file.readline(MAX_LINE)
+            if not line:
+                raise ConnectionError('the server closed the connection')
+            if not line[:3].isdigit():
+                raise SMTPError(0, [line.decode(errors='replace').rstrip()])
+            lines.append(line[4:].rstrip(b'\r\n').decode(errors='replace'))
+            if line[3:4] != b'-':
+                return int(line[:3]), lines
+
+    @staticmethod
+    def expect(reply: tuple[int, list[str]], code: int) -> tuple[int, list[str]]:
+        if reply[0] != code:
+            raise SMTPError(*reply)
+        return reply
+
+    def command(self, line: str) -> tuple[int, list[str]]:
+        self._sock.sendall(line.encode() + b'\r\n')
+        return self.reply()
+
+    def send(self, sender: str, recipients: list[str], data) -> dict:
+        """
+        Отправляет письмо, получатели делятся на транзакции по MAX_RECIPIENTS.
+        :param data: письмо в виде для DATA, повторно итерируемые куски bytes (StreamingMessage)
+        :return: словарь отвергнутый получатель -> SMTPError; если не принят никто, исключение
+        """
+        refused = {}
+        for start in range(0, len(recipients), MAX_RECIPIENTS):
+            batch = recipients[start:start + MAX_RECIPIENTS]
+            try:
+                refused.update(self._transaction(sender, batch, data))
+            except SMTPError as e:
+                if len(batch) == len(recipients):
+                    raise
+                refused.update(dict.fromkeys(batch, e))
+        if len(refused) == len(recipients):
+            raise next(iter(refused.values()))
+        self.messages += 1
+        return refused
+
+    def _transaction(self, sender: str, recipients: list[str], data) -> dict:
+        commands = [f'MAIL FROM:<{sender}>'] + [f'RCPT TO:<{recipient}>' for recipient in recipients]
+        if self.pipelining:
+            self._sock.sendall(''.join(command + '\r\n' for command in commands + ['DATA']).encode())
+            replies = [self.reply() for _ in range(len(commands) + 1)]
+        else:
+            replies = [self.command(commands[0])]
+            if replies[0][0] == 250:
+                replies += [self.command(command) for command in commands[1:]]
+        mail, answers = replies[0], replies[1:len(commands)]
+        refused = {recipient: SMTPError(*reply) for recipient, reply in zip(recipients, answers) if reply[0] >= 300}
+        if self.pipelining:
+            data_reply = replies[-1]
+        elif mail[0] == 250 and len(refused) < len(recipients):
+            data_reply = self.command('DATA')
+        else:
+            data_reply = (503, ['no valid recipients'])
+        if data_reply[0] == 354:
+            # по RFC 2920 при PIPELINING сервер может принять DATA, даже отвергнув всех: письмо обрывается пустым
+            if mail[0] == 250 and len(refused) < len(recipients):
+                buffer = bytearray()  # мелкие куски (заголовки, текст) склеиваются, чтобы не слать крошечные сегменты
+                for chunk in data:
+                    buffer += chunk
+                    if len(buffer) >= CHUNK:
+                        self._sock.sendall(buffer)
+                        buffer.clear()
+                self._sock.sendall(buffer)
+            else:
+                self._sock.sendall(b'.\r\n')
+            data_reply = self.reply()
+        if mail[0] != 250:
+            self.command('RSET')
+            raise SMTPError(*mail)
+        if len(refused) == len(recipients):
+            self.command('RSET')
+            raise next(iter(refused.values()))
+        self.expect(data_reply, 250)
+        return refused
+
+    def close(self):
+        try:
+            self.command('QUIT')
+        except (OSError, SMTPError):
+            pass
+        self.abort()
+
+    def abort(self):
+        self._file.close()
+        self._sock.close()
+
+
+class SessionPool:
+    """
+    Сессии по одной на почтовый сервер (запись MAIL_SERVERS): все письма на сервер идут по уже авторизованной
+    сессии, и рукопожатие TCP, TLS и AUTH оплачивается один раз. Оборвавшаяся сессия открывается заново.
+    """
+
+    def __init__(self, sender: str, password: str, tls: bool = None):
+        self._sender = sender
+        self._password = password
+        self._tls = tls
+        self._sessions = {}  # (хост, порт) -> SMTPSession
+        self.connections = 0
+
+    def session(self, server: tuple[str, int]) -> SMTPSession:
+        session = self._sessions.get(server)
+        if session is None:
+            session = SMTPSession(server, self._tls, self._sender.split('@')[0])
+            session.login(self._sender, self._password)
+            self._sessions[server] = session
+            self.connections += 1
+        return session
+
+    def send(self, server: tuple[str, int], recipients: list[str], data) -> dict:
+        """
+        :return: словарь отвергнутый получатель -> SMTPError
+        """
+        try:
+            return self.session(server).send(self._sender, recipients, data)
+        except (OSError, SMTPError) as e:
+            if isinstance(e, SMTPError) and e.code != 421 or server not in self._sessions:
+                raise
+            # сервер закрыл простаивавшую сессию (421 или обрыв) - одна попытка по новой
+            self._sessions.pop(server).abort()
+            return self.session(server).send(self._sender, recipients, data)
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+
+
+class Spool:
+    """
+    Очередь писем на диске: снимок (строки JSON с письмами) и журнал изменений после него (add, done, retry,
+    fail). Добавленные письма записываются в журнал с fsync до того, как считаются поставленными в очередь,
+    поэтому после перезапуска не теряется ни одно; отметки об отправке пишутся пачками, и после сбоя письмо
+    может уйти повторно. Журнал больше COMPACT_JOURNAL_SIZE сворачивается в новый снимок.
+    """
+
+    def __init__(self, file_name: str = SPOOL_FILE):
+        self._file_name = file_name
+        self._lock = threading.Lock()
+        self._pending = []  # записи журнала, ещё не сброшенные на диск
+        self.messages = {}  # id -> письмо: to, subject, text, attachments, server, attempts, next
+        self._next_id = 1
+        try:
+            with open(file_name, 'rb') as f:
+                self._replay(f.read())
+        except FileNotFoundError:
+            pass
+        try:
+            with open(file_name + JOURNAL_SUFFIX, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        end = self._replay(data)
+        self._journal = open(file_name + JOURNAL_SUFFIX, 'ab')
+        if end < len(data):  # запись, оборванная сбоем
+            self._journal.truncate(end)
+
+    def _replay(self, data: bytes) -> int:
+        """
+        :return: смещение после последней целой записи
+        """
+        offset = 0
+        while (end := data.find(b'\n', offset)) != -1:
+            try:
+                record = json.loads(data[offset:end])
+            except ValueError:
+                break
+            offset = end + 1
+            op = record.pop('op', 'add')
+            if op == 'add':
+                self.messages[record['id']] = record
+                self._next_id = max(self._next_id, record['id'] + 1)
+            elif op == 'retry' and record['id'] in self.messages:
+                self.messages[record['id']].update(attempts=record['attempts'], next=record['next'])
+            else:
+                self.messages.pop(record['id'], None)
+        return offset
+
+    def _write(self, record: dict):
+        self._pending.append(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+
+    def add(self, recipient: str, subject: str, text: str, attachments: list[str], server: tuple[str, int]) -> int:
+        with self._lock:
+            message_id = self._next_id
+            self._next_id += 1
+            self.messages[message_id] = message = {'id': message_id, 'to': recipient, 'subject': subject,
+                                                   'text': text, 'attachments': attachments,
+                                                   'server': list(server), 'attempts': 0, 'next': 0}
+            self._write({'op': 'add', **message})
+        return message_id
+
+    def done(self, message_id: int):
+        with self._lock:
+            self.messages.pop(message_id, None)
+            self._write({'op': 'done', 'id': message_id})
+
+    def fail(self, message_id: int, error: str):
+        with self._lock:
+            self.messages.pop(message_id, None)
+            self._write({'op': 'fail', 'id': message_id, 'error': error})
+
+    def retry(self, message_id: int, attempts: int, next_attempt: float):
+        with self._lock:
+            self.messages[message_id].update(attempts=attempts, next=next_attempt)
+            self._write({'op': 'retry', 'id': message_id, 'attempts': attempts, 'next': next_attempt})
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            self._journal.write(b''.join(self._pending))
+            self._pending.clear()
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            if self._journal.tell() > COMPACT_JOURNAL_SIZE:
+                self._compact()
+
+    def _compact(self):
+        with open(self._file_name + '.tmp', 'wb') as f:
+            for message in self.messages.values():
+                f.write(json.dumps(message, ensure_ascii=False).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._file_name + '.tmp', self._file_name)
+        self._journal.close()
+        self._journal = open(self._file_name + JOURNAL_SUFFIX, 'wb')
+
+    def close(self):
+        self.flush()
+        self._journal.close()
+
+
+class RateLimit:
+    """
+    Не чаще rate событий в секунду на всех потоках: каждому назначается своё время, ждут вне блокировки.
+    """
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now)
+            delay = self._next - now
+            self._next += self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MailQueue:
+    """
+    Отправка писем из Spool пулом потоков: на каждый сервер - concurrency потоков со своей сессией и общий
+    предел rate писем в секунду. Временные отказы (4xx, обрыв соединения) повторяются через RETRY_DELAY,
+    удваивая задержку с каждой попыткой, до MAX_ATTEMPTS попыток; постоянные (5xx, недоступные файлы вложений)
+    и непредвиденные ошибки записываются как неудачные.
+    Раз в REPORT_INTERVAL печатается пропускная способность.
+    """
+
+    def __init__(self, spool: Spool, sender: str, password: str, tls: bool = None,
+                 concurrency: int = SERVER_CONCURRENCY, rate: float = SERVER_RATE, cache: AttachmentCache = None):
+        self._spool = spool
+        self._sender = sender
+        self._password = password
+        self._tls = tls
+        self._concurrency = concurrency
+        self._rate = rate
+        self._cache = cache or AttachmentCache()
+        self._jobs = {}  # сервер -> queue.Queue id писем
+        self._limits = {}  # сервер -> RateLimit
+        self._workers = []
+        self._pools = []
+        self._delayed = []  # куча (время повтора, id)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()  # при прерывании потоки не берут новые письма, те остаются в Spool
+        self.delivered = self.retries = self.failed = 0
+
+    def run(self):
+        """
+        Отправляет все письма очереди, включая оставшиеся с прошлого запуска, и возвращается, когда она пуста.
+        """
+        started = report_at = time.monotonic()
+        delivered_at_report = 0
+        for message in list(self._spool.messages.values()):
+            self._schedule(message)
+        try:
+            while self._spool.messages:
+                time.sleep(FLUSH_INTERVAL)
+                now = time.time()
+                with self._lock:
+                    while self._delayed and self._delayed[0][0] <= now:
+                        message = self._spool.messages.get(heapq.heappop(self._delayed)[1])
+                        if message is not None:
+                            self._queue(message)
+                self._spool.flush()
+                if time.monotonic() - report_at >= REPORT_INTERVAL:
+                    report_at = time.monotonic()
+                    self.show(f'{report_at - started:6.1f}s', (self.delivered - delivered_at_report) / REPORT_INTERVAL)
+                    delivered_at_report = self.delivered
+        finally:
+            self._stopped.set()
+            for jobs in self._jobs.values():
+                for _ in range(self._concurrency):
+                    jobs.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._spool.flush()
+        elapsed = time.monotonic() - started
+        self.show(' total', self.delivered / elapsed if elapsed else 0)
+
+    def show(self, label: str, rate: float):
+        connections = sum(pool.connections for pool in self._pools)
+        print(f'{label} {rate:8.1f} emails/s  delivered {self.delivered}  retries {self.retries}  '
+              f'failed {self.failed}  queued {len(self._spool.messages)}  connections {connections}', flush=True)
+
+    def _schedule(self, message: dict):
+        if message['next'] > time.time():
+            with self._lock:
+                heapq.heappush(self._delayed, (message['next'], message['id']))
+        else:
+            self._queue(message)
+
+    def _queue(self, message: dict):
+        server = tuple(message['server'])
+        if server not in self._jobs:
+            self._jobs[server] = queue.SimpleQueue()
+            self._limits[server] = RateLimit(self._rate)
+            for _ in range(self._concurrency):
+                worker = threading.Thread(target=self._work, args=(server,), daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        self._jobs[server].put(message['id'])
+
+    def _work(self, server: tuple[str, int]):
+        pool = SessionPool(self._sender, self._password, self._tls)
+        self._pools.append(pool)
+        jobs = self._jobs[server]
+        try:
+            while (message_id := jobs.get()) is not None:
+                if self._stopped.is_set():
+                    break
+                message = self._spool.messages.get(message_id)
+                if message is None:
+                    continue
+                try:
+                    self._send(pool, server, message)
+                except Exception as e:
+                    # поток не должен умирать: письмо осталось бы в очереди, и run() ждал бы его вечно
+                    traceback.print_exc()
+                    pool.close()
+                    self._fail(message, e)
+        finally:
+            pool.close()
+
+    def _send(self, pool: SessionPool, server: tuple[str, int], message: dict):
+        try:
+            # вложения кодируются до сессии: отсутствующий или нечитаемый файл не исправится повтором
+            for attachment in message['attachments']:
+                self._cache.path(attachment)
+        except OSError as e:
+            self._fail(message, e)
+            return
+        self._limits[server].wait()
+        try:
+            pool.send(server, [message['to']], StreamingMessage(
+                self._sender, message['to'], message['subject'], message['text'], message['attachments'],
+                self._cache))
+        except SMTPError as e:
+            if e.temporary:
+                self._retry(message, e)
+            else:
+                self._fail(message, e)
+        except OSError as e:
+            pool.close()  # сессия могла остаться в середине транзакции
+            self._retry(message, e)
+        else:
+            self._spool.done(message['id'])
+            with self._lock:
+                self.delivered += 1
+
+    def _retry(self, message: dict, error: Exception):
+        attempts = message['attempts'] + 1
+        if attempts >= MAX_ATTEMPTS:
+            self._fail(message, error)
+            return
+        next_attempt = time.time() + RETRY_DELAY * 2 ** (attempts - 1)
+        self._spool.retry(message['id'], attempts, next_attempt)
+        with self._lock:
+            self.retries += 1
+            heapq.heappush(self._delayed, (next_attempt, message['id']))
+
+    def _fail(self, message: dict, error: Exception):
+        print(f'Email delivery to {message["to"]} failed, {error}', flush=True)
+        self._spool.fail(message['id'], str(error))
+        with self._lock:
+            self.failed += 1
 
 
 class Client:
     def __init__(self):
         self.sender, self.password, self.recipients, self.subject, self.attachments = self.check_config()
         self.mail_server = MAIL_SERVERS[self.sender.split('@')[1]]
-        self.count_parcels = 0
-        # переменная введена в попытке избежать отклонения отправки сообщения из-за подозрения на спам
 
     @staticmethod
     def check_config():
@@ -40,53 +638,64 @@ class Client:
             print('Данные были введены не верно!\nПрочитайте README.md и введите данные корректно!')
             sys.exit()
 
-    @staticmethod
-    def request(s, r):
-        """
-        Выполнение запроса и получение ответа.
-        :param s: socket
-        :param r: type of request, e.g. EHLO, AUTH LOGIN etc.
-        :return: decoded response from ...
-        """
-        s.send((r + '\n').encode())
-        return s.recv(65535).decode()
-
-    def start(self) -> None:
-        """
-        Этот класс был оставлен еще с пары и модифицирован под логику моего класса без потери функциональности.
-        Может отправлять сообщения в соответствии с поставленной задачей, но без вложений.
-        """
-        for recipient in self.recipients:
-            with socket(AF_INET, SOCK_STREAM) as client:
-                client.connect(self.mail_server)
-                client = ssl.wrap_socket(client)
-                print(self.request(client, f'EHLO {self.sender.split("@")[0]}'))
-                base64_auth = base64.b64encode(('\x00' + self.sender + '\x00' + self.password).encode()).decode()
-                print(self.request(client, 'AUTH PLAIN'))
-                print(self.request(client, base64_auth))
-                print(self.request(client, f'MAIL FROM: {self.sender}'))
-                print(self.request(client, f'RCPT TO: {recipient}'))
-                print(self.request(client, 'DATA'))
-                print(self.request(client, self.get_message(recipient)))
-                print(self.request(client, 'QUIT'))
-
-    def get_message(self, recipient) -> str:
-        """
-        Непосредственно создание сообщения с необходимыми полями
-        :param recipient:
-        :return: message, string
+    def start(self, tls: bool = None, repeat: int = 1) -> None:
         """
+        Отправка по одной сессии на сервер (SessionPool): каждому получателю - своё письмо с вложениями,
+        все они идут по одному соединению, с PIPELINING, если сервер его поддерживает. Письма собираются
+        потоком (StreamingMessage), вложения кодируются один раз (AttachmentCache).
+        :param repeat: сколько писем отправить каждому получателю
+        """
+        pool = SessionPool(self.sender, self.password, tls)
+        cache = AttachmentCache()
+        started = time.perf_counter()
+        delivered = 0
+        try:
+            for _ in range(repeat):
+                for recipient in self.recipients:
+                    try:
+                        pool.send(self.mail_server, [recipient], self.get_streaming_message(recipient, cache))
+                        delivered += 1
+                    except SMTPError as e:
+                        print(f'Email delivery to {recipient} failed, {e}')
+        except OSError as e:
+            print('Email delivery failed, failure in connect', e)
+        finally:
+            pool.close()
+        elapsed = time.perf_counter() - started
+        print(f'{delivered} emails delivered in {elapsed:.2f} s over {pool.connections} connection(s)')
+
+    def get_streaming_message(self, recipient: str, cache: AttachmentCache) -> StreamingMessage:
+        """
+        Письмо получателю с вложениями, собираемое потоком при отправке.
+        """
+        return StreamingMessage(self.sender, recipient, self.subject, self.get_text(), self.get_attachments(), cache)
+
+    @staticmethod
+    def get_text() -> str:
         with open('files/message.txt', 'r', encoding='utf-8') as f:
-            message = f.read()
-        self.count_parcels += 1
-        return f"From: {self.sender}\nTo: {recipient}\nSubject: {self.subject}\nContent-Type: text/plain\n\n{message + ' ' * self.count_parcels}\n.\n"
+            return f.read()
+
+    def get_attachments(self) -> list[str]:
+        return [os.path.join(ATTACHMENTS_DIR, name.strip()) for name in self.attachments if name.strip()]
+
+    def enqueue(self, spool: Spool, repeat: int = 1) -> int:
+        """
+        Ставит в очередь на диске письма каждому получателю, repeat раз.
+        :return: сколько писем поставлено
+        """
+        text, attachments = self.get_text(), self.get_attachments()
+        for _ in range(repeat):
+            for recipient in self.recipients:
+                spool.add(recipient, self.subject, text, attachments, self.mail_server)
+        spool.flush()
+        return repeat * len(self.recipients)
 
-    def start_with_smtplib(self) -> None:
+    def start_with_smtplib(self, tls: bool = True) -> None:
         """
         Запуск клиента и отправка сообщения с вложениями (?) кому-либо.
         """
         try:
-            client = smtplib.SMTP_SSL(*self.mail_server)
+            client = smtplib.SMTP_SSL(*self.mail_server) if tls else smtplib.SMTP(*self.mail_server)
             client.login(self.sender, self.password)
             message = self.get_message_with_smtplib()
             # print(message)
@@ -134,4 +743,35 @@ class Client:
 
 
 if __name__ == '__main__':
-    Client().start_with_smtplib()
+    parser = argparse.ArgumentParser(description='SMTP client sending files/message.txt as set in files/config.txt')
+    parser.add_argument('--session', action='store_true',
+                        help='send every recipient its own email over one pipelined session')
+    parser.add_argument('--server', help="HOST:PORT instead of the sender's mail server, e.g. a local stand-in")
+    parser.add_argument('--plain', action='store_true', help='no TLS on connect (STARTTLS is still used if offered)')
+    parser.add_argument('--repeat', type=int, default=1, help='emails per recipient with --session or --queue')
+    parser.add_argument('--queue', action='store_true',
+                        help='put the emails into the on-disk spool and send everything in it')
+    parser.add_argument('--drain', action='store_true', help='only send what is left in the spool')
+    parser.add_argument('--spool', default=SPOOL_FILE, help='spool file, its journal is next to it')
+    parser.add_argument('--concurrency', type=int, default=SERVER_CONCURRENCY, help='sessions per mail server')
+    parser.add_argument('--rate', type=float, default=SERVER_RATE, help='emails per second per server, 0 - no limit')
+    args = parser.parse_args()
+    client = Client()
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        client.mail_server = (host, int(port))
+    tls = False if args.plain else None
+    if args.queue or args.drain:
+        spool = Spool(args.spool)
+        try:
+            if args.queue:
+                print(f'{client.enqueue(spool, args.repeat)} emails queued, {len(spool.messages)} in the spool')
+            MailQueue(spool, client.sender, client.password, tls, args.concurrency, args.rate).run()
+        except KeyboardInterrupt:
+            print(f'stopped, {len(spool.messages)} emails stay in the spool')
+        finally:
+            spool.close()
+    elif args.session:
+        client.start(tls, args.repeat)
+    else:
+        client.start_with_smtplib(not args.plain)
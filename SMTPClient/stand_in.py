@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import base64
+import os
+import random
+import time
+
+HOST = '127.0.0.1'
+PORT = 2525
+REPORT_INTERVAL = 1
+MAX_SIZE = 50 * 1024 * 1024
+
+
+class Stats:
+    def __init__(self):
+        self.connections = self.messages = self.recipients = self.bytes = self.temporary_failures = 0
+
+
+class StandIn:
+    """Stand-in SMTP server for tests: takes any AUTH PLAIN, advertises PIPELINING and only counts the mail."""
+
+    def __init__(self, save=None, temp_fail=0.0, delay=0.0, pipelining=True, seed=1):
+        self.save = save
+        self.temp_fail = temp_fail
+        self.delay = delay
+        self.pipelining = pipelining
+        self.random = random.Random(seed)
+        self.stats = Stats()
+
+    async def handle(self, reader, writer):
+        self.stats.connections += 1
+        writer.write(b'220 stand-in ESMTP\r\n')
+        authenticated, sender, recipients = False, None, []
+        try:
+            while line := await reader.readline():
+                verb, _, argument = line.decode(errors='replace').rstrip('\r\n').partition(' ')
+                verb = verb.upper()
+                if verb == 'EHLO':
+                    extensions = ['stand-in'] + ['PIPELINING'] * self.pipelining + [
+                        'AUTH PLAIN', '8BITMIME', f'SIZE {MAX_SIZE}']
+                    writer.write(''.join(f'250{" " if number == len(extensions) - 1 else "-"}{extension}\r\n'
+                                         for number, extension in enumerate(extensions)).encode())
+                elif verb == 'HELO':
+                    writer.write(b'250 stand-in\r\n')
+                elif verb == 'AUTH':
+                    token = argument.partition(' ')[2]
+                    if not token:
+                        writer.write(b'334 \r\n')
+                        token = (await reader.readline()).decode().strip()
+                    try:
+                        authenticated = base64.b64decode(token, validate=True).count(b'\0') == 2
+                    except ValueError:
+                        authenticated = False
+                    writer.write(b'235 2.7.0 accepted\r\n' if authenticated else b'535 5.7.8 bad credentials\r\n')
+                elif verb == 'MAIL':
+                    if not authenticated:
+                        writer.write(b'530 5.7.0 authentication required\r\n')
+                    elif self.random.random() < self.temp_fail:
+                        self.stats.temporary_failures += 1
+                        writer.write(b'451 4.3.0 try again later\r\n')
+                    else:
+                        sender, recipients = argument, []
+                        writer.write(b'250 2.1.0 ok\r\n')
+                elif verb == 'RCPT':
+                    if sender is None:
+                        writer.write(b'503 5.5.1 MAIL first\r\n')
+                    else:
+                        recipients.append(argument.partition(':')[2].strip('<>'))
+                        writer.write(b'250 2.1.5 ok\r\n')
+                elif verb == 'DATA':
+                    if not recipients:
+                        writer.write(b'554 5.5.1 no valid recipients\r\n')
+                        continue
+                    writer.write(b'354 end with <CRLF>.<CRLF>\r\n')
+                    await writer.drain()
+                    message = await self.read_data(reader)
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self.stats.messages += 1
+                    self.stats.recipients += len(recipients)
+                    self.stats.bytes += len(message)
+                    if self.save:
+                        with open(os.path.join(self.save, f'{self.stats.messages}.eml'), 'wb') as f:
+                            f.write(message)
+                    sender, recipients = None, []
+                    writer.write(b'250 2.0.0 queued\r\n')
+                elif verb == 'RSET':
+                    sender, recipients = None, []
+                    writer.write(b'250 2.0.0 ok\r\n')
+                elif verb == 'NOOP':
+                    writer.write(b'250 2.0.0 ok\r\n')
+                elif verb == 'QUIT':
+                    writer.write(b'221 2.0.0 bye\r\n')
+                    break
+                else:
+                    writer.write(b'502 5.5.2 command not implemented\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_data(reader):
+        lines = []
+        while (line := await reader.readline()) not in (b'.\r\n', b''):
+            lines.append(line[1:] if line.startswith(b'.') else line)
+        return b''.join(lines)
+
+
+async def serve(args):
+    stand_in = StandIn(args.save, args.temp_fail, args.delay, not args.no_pipelining)
+    server = await asyncio.start_server(stand_in.handle, args.host, args.port)
+    print(f'stand-in SMTP server on {args.host}:{args.port}', flush=True)
+    stats = stand_in.stats
+    messages_at_report = 0
+    async with server:
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            if stats.messages != messages_at_report:
+                print(f'{time.strftime("%H:%M:%S")} {(stats.messages - messages_at_report) / REPORT_INTERVAL:8.0f} '
+                      f'messages/s  total {stats.messages}, recipients {stats.recipients}, '
+                      f'{stats.bytes // 1024} KiB, connections {stats.connections}, '
+                      f'temporary failures {stats.temporary_failures}', flush=True)
+                messages_at_report = stats.messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in SMTP server to test smtp.py against')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--save', help='directory to write every received message to as N.eml')
+    parser.add_argument('--temp-fail', type=float, default=0.0, help='share of MAIL FROM answered with 451')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before accepting every message')
+    parser.add_argument('--no-pipelining', action='store_true', help='do not advertise PIPELINING')
+    args = parser.parse_args()
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
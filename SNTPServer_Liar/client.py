@@ -1,19 +1,169 @@
 from socket import *
+import argparse
+import asyncio
+import datetime
+import struct
+import time
 
 HOST = 'localhost'
 PORT = 123
 ADDR = (HOST, PORT)
+TIMEOUT = 2
+SOCKETS = 8  # разные порты клиента попадают в разные процессы сервера с SO_REUSEPORT
+REPORT_INTERVAL = 1
+NTP_EPOCH = 2208988800
+NTP_PACKET = struct.Struct('!BBBbII4sQQQQ')
+REQUEST = 4 << 3 | 3  # VN 4, mode 3 (клиент)
+
+
+def to_ntp(seconds: float) -> int:
+    return int((seconds + NTP_EPOCH) * (1 << 32))
+
+
+def from_ntp(timestamp: int) -> float:
+    return timestamp / (1 << 32) - NTP_EPOCH
+
+
+def request(transmit: int) -> bytes:
+    return NTP_PACKET.pack(REQUEST, 0, 0, 0, 0, 0, b'\0' * 4, 0, 0, 0, transmit)
+
+
+def measure(data: bytes, sent: float, received: float) -> tuple[float, float]:
+    """
+    Смещение и задержка по четырём отметкам времени (RFC 4330): t1 - отправка запроса, t2 - приём сервером,
+    t3 - отправка ответа, t4 - приём ответа.
+    :return: (offset, delay) в секундах
+    """
+    _, _, _, _, _, _, _, _, _, t2, t3 = NTP_PACKET.unpack_from(data)
+    t2, t3 = from_ntp(t2), from_ntp(t3)
+    return ((t2 - sent) + (t3 - received)) / 2, (received - sent) - (t3 - t2)
 
 
 class TimeClient:
     @staticmethod
-    def start():
+    def start(addr: tuple[str, int] = ADDR):
         udp_socket = socket(AF_INET, SOCK_DGRAM)
-        udp_socket.sendto(b'tell me time', ADDR)
-        data = udp_socket.recvfrom(1024)
-        print(data[0].decode())
+        udp_socket.settimeout(TIMEOUT)
+        sent = time.time()
+        udp_socket.sendto(request(to_ntp(sent)), addr)
+        data = udp_socket.recvfrom(1024)[0]
+        received = time.time()
         udp_socket.close()
+        offset, delay = measure(data, sent, received)
+        server_time = datetime.datetime.now() + datetime.timedelta(seconds=offset)
+        print(f'current time is {server_time:%H:%M:%S}, offset {offset:+.6f} s, delay {delay * 1000:.3f} ms')
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    """
+    Один сокет нагрузки. Запросы узнаются по своему transmit timestamp, который сервер возвращает в origin.
+    """
+
+    def __init__(self, stats: 'Stats'):
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        received = time.time()
+        if len(data) < NTP_PACKET.size:
+            return
+        sent = self.stats.in_flight.pop(data[24:32], None)
+        if sent is None:
+            return
+        offset, delay = measure(data, sent, received)
+        self.stats.offsets.append(offset)
+        self.stats.delays.append(delay)
+        self.stats.answered += 1
+
+    def send(self):
+        sent = time.time()
+        transmit = to_ntp(sent)
+        while transmit.to_bytes(8, 'big') in self.stats.in_flight:  # одинаковое время двух запросов
+            transmit += 1
+        self.stats.in_flight[transmit.to_bytes(8, 'big')] = sent
+        self.transport.sendto(request(transmit))
+        self.stats.sent += 1
+
+
+class Stats:
+    def __init__(self):
+        self.in_flight = {}  # transmit timestamp -> время отправки
+        self.offsets = []
+        self.delays = []
+        self.sent = self.answered = self.lost = 0
+
+    def expire(self, timeout: float):
+        deadline = time.time() - timeout
+        expired = [key for key, sent in self.in_flight.items() if sent < deadline]
+        for key in expired:
+            del self.in_flight[key]
+        self.lost += len(expired)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+async def load(addr: tuple[str, int], rate: int, duration: float, sockets: int = SOCKETS, timeout: float = TIMEOUT):
+    """
+    Открытая нагрузка: запросы уходят с частотой rate независимо от ответов, поэтому очередь на сервере
+    видна в задержке, а переполнение - в потерях. Раз в REPORT_INTERVAL печатает пропускную способность,
+    потери, перцентили задержки и разброс смещения.
+    """
+    loop = asyncio.get_running_loop()
+    stats = Stats()
+    clients = []
+    for _ in range(sockets):
+        _, client = await loop.create_datagram_endpoint(lambda: LoadClient(stats), remote_addr=addr)
+        clients.append(client)
+    started = time.perf_counter()
+    report_at = started + REPORT_INTERVAL
+    answered_at_report = 0
+    offsets, delays = [], []
+    while (now := time.perf_counter()) < started + duration:
+        for _ in range(int((now - started) * rate) - stats.sent):
+            clients[stats.sent % sockets].send()
+        if now >= report_at:
+            stats.expire(timeout)
+            show(f'{now - started:6.1f}s', stats, stats.answered - answered_at_report, REPORT_INTERVAL)
+            answered_at_report = stats.answered
+            offsets += stats.offsets
+            delays += stats.delays
+            stats.offsets, stats.delays = [], []
+            report_at += REPORT_INTERVAL
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(timeout)
+    stats.expire(0)
+    stats.offsets, stats.delays = offsets + stats.offsets, delays + stats.delays
+    show(' total', stats, stats.answered, duration)
+    for client in clients:
+        client.transport.close()
+
+
+def show(label: str, stats: Stats, answered: int, interval: float):
+    delays = sorted(stats.delays)
+    offsets = stats.offsets
+    line = f'{label} {answered / interval:9.0f} qps  sent {stats.sent}  lost {stats.lost}  ' \
+           f'delay p50 {percentile(delays, 0.5) * 1000:.3f} p99 {percentile(delays, 0.99) * 1000:.3f} ' \
+           f'p999 {percentile(delays, 0.999) * 1000:.3f} ms'
+    if offsets:
+        line += f'  offset {sum(offsets) / len(offsets):+.6f} s [{min(offsets):+.6f} .. {max(offsets):+.6f}]'
+    print(line, flush=True)
 
 
 if __name__ == '__main__':
-    TimeClient().start()
+    parser = argparse.ArgumentParser(description='SNTP client: one query or a load test of the server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--rate', type=int, help='queries per second, turns on the load test')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--sockets', type=int, default=SOCKETS, help='client sockets the load is spread over')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds before a query counts as lost')
+    args = parser.parse_args()
+    if args.rate:
+        asyncio.run(load((args.host, args.port), args.rate, args.duration, args.sockets, args.timeout))
+    else:
+        TimeClient().start((args.host, args.port))
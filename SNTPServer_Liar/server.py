@@ -1,44 +1,181 @@
 from socket import *
+import argparse
 import datetime
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Metrics, Reporter, add_arguments, options, worker_options  # noqa: E402
 
 HOST = 'localhost'
 PORT = 123
 ADDR = (HOST, PORT)
 CFG = 'config.txt'
+WORKERS = os.cpu_count() or 1
+BATCH = 64  # сколько запросов вычитывается из сокета подряд, прежде чем отправить ответы
+RECEIVE_BUFFER = 4 * 1024 * 1024
+NTP_EPOCH = 2208988800  # секунд между 1900-01-01 (эпоха NTP) и 1970-01-01
+NTP_PACKET = struct.Struct('!BBBbII4sQQQQ')
+NTP_PACKET_SIZE = NTP_PACKET.size  # 48
+MODE_CLIENT = 3
+MODE_SERVER = 4
+STRATUM = 1
+PRECISION = -20  # около микросекунды
+REFERENCE_ID = b'LOCL'
+ROOT_DISPERSION = 1 << 6  # 1 мс в формате 16.16
+# значения из linux/socket.h: время приёма датаграммы ядром в ancillary data
+SO_TIMESTAMPNS = globals().get('SO_TIMESTAMPNS', 35 if sys.platform.startswith('linux') else None)
+TIMESPEC = struct.Struct('@ll')
+
+
+def to_ntp(seconds: float) -> int:
+    """
+    Время Unix в 64-битный формат NTP: 32 бита секунд с 1900 года и 32 бита долей секунды.
+    """
+    return int((seconds + NTP_EPOCH) * (1 << 32)) & 0xFFFFFFFFFFFFFFFF
 
 
 class TimeServer:
-    def __init__(self, config):
-        self.time_offset, self.sign = self.get_offset(config)
+    def __init__(self, config, metrics: Metrics = None):
+        self.time_offset = self.get_offset(config)
+        self._reference = to_ntp(time.time() + self.time_offset)
+        self._text = (None, b'')  # (секунда, ответ) на текстовый запрос
+        self.metrics = metrics or Metrics('sntp')
+        self._requests = self.metrics.counter('requests')
+        self._ignored = self.metrics.counter('requests.ignored')
+        self._replies = self.metrics.counter('replies')
+        self._send_errors = self.metrics.counter('replies.errors')
+        self._response = self.metrics.histogram('response')
 
     @staticmethod
-    def get_offset(file: str) -> (int, int):
+    def get_offset(file: str) -> int:
         try:
             with open(file) as f:
-                offset = f.readline()
-                if offset.isdigit():
-                    return int(offset), 1
-                elif offset[0] == '-' and offset[1:].isdigit():
-                    return int(offset), -1
-                else:
-                    return 0, 0
+                offset = f.readline().strip()
+                if offset.isdigit() or offset[:1] == '-' and offset[1:].isdigit():
+                    return int(offset)
+                return 0
         except Exception:
-            return 0, 0
+            return 0
+
+    def start(self, host: str = HOST, port: int = PORT, workers: int = WORKERS, reporting: dict = None):
+        """
+        Запускает workers процессов на одном порту через SO_REUSEPORT: ядро само раскладывает запросы
+        между их сокетами. Без SO_REUSEPORT (Windows) работает один процесс.
+        :param reporting: параметры Reporter; у каждого процесса свои метрики, порт статистики и файл профиля
+        """
+        reporting = reporting or {}
+        if workers <= 1 or 'SO_REUSEPORT' not in globals():
+            self.serve(host, port, reporting)
+            return
+        processes = [multiprocessing.Process(target=self.serve, args=(host, port, worker_options(reporting, number)),
+                                             daemon=True)
+                     for number in range(workers)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join(1)  # Ctrl+C получают и процессы, даём им дописать профиль
+                process.terminate()
 
-    def start(self):
+    def serve(self, host: str = HOST, port: int = PORT, reporting: dict = None):
         with socket(AF_INET, SOCK_DGRAM) as udp_socket:
-            udp_socket.bind(ADDR)
-            while 1:
-                conn, addr = udp_socket.recvfrom(1024)
-                print('client addr: ', addr)
-                if conn.decode() == 'tell me time':
-                    message = f'current time is {self.get_wrong_time()}'
-                    # print(message)
-                    udp_socket.sendto(message.encode(), addr)
+            if 'SO_REUSEPORT' in globals():
+                udp_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            udp_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER)
+            timestamps = False
+            if SO_TIMESTAMPNS is not None:
+                try:
+                    udp_socket.setsockopt(SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                    timestamps = True
+                except OSError:
+                    pass
+            udp_socket.bind((host, port))
+            with Reporter(self.metrics, **(reporting or {})):
+                try:
+                    self.loop(udp_socket, timestamps)
+                except KeyboardInterrupt:
+                    pass
+
+    def loop(self, udp_socket: socket, timestamps: bool):
+        """
+        Ждёт первый запрос, затем без блокировки дочитывает до BATCH уже пришедших и отвечает на все разом.
+        Время приёма берётся из ядра (SO_TIMESTAMPNS), если оно доступно.
+        """
+        ancillary = CMSG_SPACE(TIMESPEC.size) if timestamps else 0
+        while True:
+            replies = []
+            flags = 0
+            for _ in range(BATCH):
+                try:
+                    if hasattr(udp_socket, 'recvmsg'):
+                        data, ancdata, _, addr = udp_socket.recvmsg(1024, ancillary, flags)
+                    else:  # Windows
+                        (data, addr), ancdata = udp_socket.recvfrom(1024), ()
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionResetError:  # Windows: ICMP на один из прошлых ответов
+                    continue
+                flags = MSG_DONTWAIT if 'MSG_DONTWAIT' in globals() else 0
+                received = None
+                for level, kind, value in ancdata:
+                    if level == SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                        seconds, nanoseconds = TIMESPEC.unpack_from(value)
+                        received = seconds + nanoseconds / 1e9
+                received = received or time.time()
+                self._requests.inc()
+                reply = self.answer(data, received)
+                if reply:
+                    replies.append((reply, addr, received))
+                else:
+                    self._ignored.inc()
+                if not flags:
+                    break
+            for reply, addr, received in replies:
+                try:
+                    udp_socket.sendto(reply, addr)
+                except OSError:
+                    self._send_errors.inc()
+                    continue
+                self._replies.inc()
+                self._response.record(time.time() - received)  # от приёма ядром до отправки, вместе с очередью
+
+    def answer(self, data: bytes, received: float) -> bytes:
+        """
+        Ответ на запрос клиента (RFC 4330): origin - transmit timestamp запроса, receive и transmit -
+        время сервера, сдвинутое на time_offset. Пустой ответ - запрос не обслуживается.
+        """
+        if data == b'tell me time':
+            return self.get_text()
+        if len(data) < NTP_PACKET_SIZE or data[0] & 7 != MODE_CLIENT:
+            return b''
+        version = data[0] >> 3 & 7
+        return NTP_PACKET.pack(version << 3 | MODE_SERVER, STRATUM, data[2], PRECISION, 0, ROOT_DISPERSION,
+                               REFERENCE_ID, self._reference, int.from_bytes(data[40:48], 'big'),
+                               to_ntp(received + self.time_offset), to_ntp(time.time() + self.time_offset))
+
+    def get_text(self) -> bytes:
+        second = int(time.time())
+        if self._text[0] != second:
+            self._text = (second, f'current time is {self.get_wrong_time()}'.encode())
+        return self._text[1]
 
     def get_wrong_time(self) -> str:
-        return (datetime.datetime.now() + self.sign * datetime.timedelta(seconds=self.time_offset)).strftime('%H:%M:%S')
+        return (datetime.datetime.now() + datetime.timedelta(seconds=self.time_offset)).strftime('%H:%M:%S')
 
 
 if __name__ == '__main__':
-    TimeServer(CFG).start()
+    parser = argparse.ArgumentParser(description='SNTP server that lies by the number of seconds in its config')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--config', default=CFG)
+    add_arguments(parser)
+    args = parser.parse_args()
+    TimeServer(args.config).start(args.host, args.port, args.workers, options(args))
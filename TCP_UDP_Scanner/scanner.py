@@ -1,11 +1,59 @@
 import argparse
+import asyncio
+import csv
+import heapq
+import ipaddress
+import itertools
+import json
+import os
+import random
+import re
 import socket
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from struct import pack
+import time
+from struct import Struct, pack
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Metrics, Reporter, add_arguments, options  # noqa: E402
 
 MAX_PORT = 65535
-PACKET = b'\x13' + b'\x00' * 39 + b'\x6f\x89\xe9\x1a\xb6\xd5\x3b\xd3'
+TCP_TIMEOUT = 0.5  # начальный таймаут, пока RTT хоста не измерен
+UDP_TIMEOUT = 3
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 3
+DISCOVERY_PORTS = (80, 443, 22, 445, 3389)  # любой ответ (SYN-ACK или RST) означает, что хост жив
+DEFAULT_CONCURRENCY = 4096
+CHECKPOINT_FILE = 'scan.checkpoint'
+CHECKPOINT_INTERVAL = 5
+OUTPUT_BUFFER = 1 << 16
+FORMATS = ('text', 'jsonl', 'csv')
+DEFAULT_SAMPLE = 0.01  # доля прочих портов, проверяемых при пересканировании вместе с известными
+BACKGROUND_SHARE = 4  # полный проход при пересканировании идёт с окном в столько раз меньше
+RESERVED_DESCRIPTORS = 64  # stdin/stdout, event loop and so on
+UDP_SOCKETS = 4  # пакетный UDP-режим: столько сокетов делят между собой все пробы
+UDP_RETRIES = 2  # повторные отправки на порты, не давшие ни ответа, ни ICMP
+UDP_SEND_ATTEMPTS = 2  # sendto с ошибкой повторяется: первая ошибка обычно осталась от прошлой пробы
+UDP_RECEIVE_BUFFER = 1 << 20
+IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)  # значения из linux/in.h и linux/socket.h,
+MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)  # в модуле socket их может не быть
+SO_EE_ORIGIN_ICMP = 2
+ICMP_UNREACHABLE = 3
+ICMP_PORT_UNREACHABLE = 3
+EXTENDED_ERROR = Struct('=IBBBB')  # struct sock_extended_err: ee_errno, ee_origin, ee_type, ee_code, ee_pad
+TCP_PROBES = 2  # сколько проб после пустого баннера посылать на открытый TCP порт
+DNS_ID = b'\x13\x00'
+TIMESTAMP = b'\x6f\x89\xe9\x1a\xb6\xd5\x3b\xd3'  # transmit timestamp наших SNTP-запросов
+# один пакет и SNTP-запрос (LI 0, VN 2, mode 3), и пустой DNS-запрос с ID 0x1300
+PACKET = b'\x13' + b'\x00' * 39 + TIMESTAMP
+DNS_QUERY = DNS_ID + pack('!HHHHH', 0x0100, 1, 0, 0, 0) + b'\x00' + pack('!HH', 2, 1)  # . IN NS
+SNTP_QUERY = b'\x23' + b'\x00' * 39 + TIMESTAMP  # VN 4, mode 3
+METRICS = Metrics('scanner')  # счётчики проб и гистограммы RTT всего процесса
+UDP_OUTCOMES = {'open': 'replies', 'closed': 'closed', 'filtered': 'filtered', 'open|filtered': 'timeouts'}
 
 
 class Arguments:
@@ -14,18 +62,61 @@ class Arguments:
     """
 
     def __init__(self):
-        self.host, self.start, self.end = self._parse_args()
+        self.hosts, self.start, self.end, self.concurrency, self.rate, self.discovery, self.output_format, \
+            self.output, self.checkpoint, self.resume, self.baseline, self.sample, self.full, \
+            self.reporting = self._parse_args()
 
     @staticmethod
-    def _parse_args() -> tuple[str, int, int]:
+    def _parse_args() -> tuple[list[str], int, int, int, float, bool, str, str, str, bool, str, float, bool, dict]:
         """
         Непосредственно парсер аргументов.
-        :return: Tuple(host, start, end)
+        :return: Tuple(hosts, start, end, concurrency, rate, discovery, output_format, output, checkpoint, resume,
+        baseline, sample, full, reporting), reporting - параметры Reporter из instrumentation
         """
         parser = argparse.ArgumentParser()
-        parser.add_argument('--host', type=str, dest='host', default='localhost', help='host to scan')
-        parser.add_argument('ports', type=str, help='port or range of ports: 1 or 1..100')
+        parser.add_argument('--host', type=str, dest='host', action='append',
+                            help='host, CIDR block or comma separated list of them, may be repeated')
+        parser.add_argument('-iL', '--hosts-file', type=str, dest='hosts_file',
+                            help='file with hosts or CIDR blocks, one per line')
+        parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                            help='how many probes may be in flight at once')
+        parser.add_argument('--rate', type=float, default=0, help='global limit of probes per second, 0 - no limit')
+        parser.add_argument('-Pn', '--no-discovery', action='store_false', dest='discovery',
+                            help='scan every host, even if it does not answer discovery probes')
+        parser.add_argument('-f', '--format', choices=FORMATS, default='text', dest='output_format',
+                            help='output format: text lines, JSON lines or CSV')
+        parser.add_argument('-o', '--output', type=str, help='write results to this file instead of stdout')
+        parser.add_argument('--checkpoint', type=str, default=CHECKPOINT_FILE, help='file with the scan progress')
+        parser.add_argument('--resume', action='store_true',
+                            help='continue the scan saved in the checkpoint, its hosts, ports and output are used')
+        parser.add_argument('--baseline', type=str,
+                            help='previous results (jsonl or csv): rescan known ports first and print only changes')
+        parser.add_argument('--sample', type=float, default=DEFAULT_SAMPLE,
+                            help='share of the other ports checked together with the known ones')
+        parser.add_argument('--full', action='store_true', help='after the changes sweep the whole range slower')
+        parser.add_argument('ports', type=str, nargs='?', help='port or range of ports: 1 or 1..100')
+        add_arguments(parser)
         arguments = parser.parse_args()
+        settings = arguments.concurrency, arguments.rate, arguments.discovery, arguments.output_format, \
+            arguments.output, arguments.checkpoint, arguments.resume, arguments.baseline, arguments.sample, \
+            arguments.full, options(arguments)
+        if arguments.resume and arguments.baseline:
+            print('Rescan against a baseline can not be resumed')
+            sys.exit()
+        if not 0 <= arguments.sample <= 1:
+            print('Sample must be between 0 and 1')
+            sys.exit()
+        if arguments.concurrency < 1:
+            print('Concurrency must be positive')
+            sys.exit()
+        if arguments.rate < 0:
+            print('Rate must not be negative')
+            sys.exit()
+        if arguments.resume:
+            return [], 0, 0, *settings
+        if arguments.ports is None:
+            print('Ports are required')
+            sys.exit()
         try:
             if '..' in arguments.ports:
                 start, end = [int(elem) for elem in arguments.ports.split('..')]
@@ -40,140 +131,854 @@ class Arguments:
         if start > end:
             print('Invalid ports')
             sys.exit()
-        try:
-            socket.gethostbyname(arguments.host)
-        except socket.gaierror:
-            print(f'Invalid host {arguments.host}')
-            sys.exit()
-        return arguments.host, start, end
+        specs = [spec for host in arguments.host or [] for spec in host.split(',')]
+        if arguments.hosts_file:
+            try:
+                with open(arguments.hosts_file) as f:
+                    specs += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            except OSError:
+                print(f'Cannot read {arguments.hosts_file}')
+                sys.exit()
+        return Arguments._expand_targets(specs or ['localhost']), start, end, *settings
 
+    @staticmethod
+    def _expand_targets(specs: list[str]) -> list[str]:
+        """
+        Разворачивает имена хостов и CIDR-блоки в список IP-адресов без повторов.
+        :param specs: список строк вида vk.com, 10.0.0.1 или 10.0.0.0/24
+        :return: список IP-адресов
+        """
+        hosts = {}
+        for spec in specs:
+            try:
+                network = ipaddress.IPv4Network(spec, strict=False)
+                addresses = network.hosts() if network.num_addresses > 2 else network
+                hosts.update(dict.fromkeys(str(address) for address in addresses))
+                continue
+            except ValueError:
+                pass
+            try:
+                hosts[socket.gethostbyname(spec)] = None
+            except socket.gaierror:
+                print(f'Invalid host {spec}')
+                sys.exit()
+        return list(hosts)
 
-"""
-Последующие 5 классов отвечают за соответствующие протоколы, 
-а точнее за проверку принадлежности к таковым. 
-"""
 
+class RTTEstimator:
+    """
+    Оценка времени отклика хоста как в TCP (RFC 6298): сглаженное RTT и его разброс,
+    из которых получается таймаут для следующих проб.
+    """
 
-class DNS:
-    @staticmethod
-    def is_dns(packet: bytes) -> bool:
-        transaction_id = PACKET[:2]
-        return transaction_id in packet
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
 
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            return TCP_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.srtt + 4 * self.rttvar))
+
+
+class RateLimiter:
+    """
+    Глобальный ограничитель частоты проб: каждая проба получает свой момент отправки,
+    следующий не раньше чем через 1 / rate секунд после предыдущего.
+    """
+    _delays = METRICS.histogram('rate.delay')
+
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate else 0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self._interval
+        self._delays.record(slot - now)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Output:
+    """
+    Единственный писатель результатов в буферизованный поток. Запись - словарь с полями FIELDS,
+    rtt в миллисекундах или None. При пересканировании записи об изменениях дополнены полями CHANGE_FIELDS.
+    """
+    FIELDS = ('host', 'port', 'proto', 'state', 'service', 'rtt')
+    CHANGE_FIELDS = ('change', 'previous_state', 'previous_service')
+    _MARKS = {'opened': '+ ', 'closed': '- ', 'changed': '~ '}
+
+    def __init__(self, stream, output_format: str, header: bool = True, changes: bool = False):
+        self._stream = stream
+        self._format = output_format
+        fields = self.FIELDS + self.CHANGE_FIELDS if changes else self.FIELDS
+        self._csv = csv.DictWriter(stream, fields) if output_format == 'csv' else None
+        if self._csv and header:
+            self._csv.writeheader()
 
-class SNTP:
     @staticmethod
-    def is_sntp(packet: bytes) -> bool:
-        transmit_timestamp = PACKET[-8:]
-        origin_timestamp = packet[24:32]
-        is_packet_from_server = 7 & packet[0] == 4
-        return len(packet) >= 48 and is_packet_from_server and origin_timestamp == transmit_timestamp
+    def open(path: str, output_format: str, append: bool = False, changes: bool = False) -> 'Output':
+        """
+        :param path: файл для результатов, None - stdout
+        :param append: дописывать в конец файла (продолжение прерванного сканирования)
+        :param changes: выводятся изменения относительно прошлого сканирования
+        """
+        if path is None:
+            return Output(sys.stdout, output_format, changes=changes)
+        return Output(open(path, 'a' if append else 'w', buffering=OUTPUT_BUFFER, newline=''), output_format,
+                      not append, changes)
+
+    @staticmethod
+    def read(path: str) -> dict:
+        """
+        Читает результаты, записанные в формате jsonl или csv.
+        :return: словарь (host, port, proto) -> (state, service)
+        """
+        with open(path, newline='') as f:
+            first = f.readline()
+            f.seek(0)
+            records = (json.loads(line) for line in f if line.strip()) if first.startswith('{') else csv.DictReader(f)
+            return {(record['host'], int(record['port']), record['proto']): (record['state'], record['service'])
+                    for record in records if record.get('change') != 'closed'}
+
+    def write(self, record: dict):
+        if self._format == 'jsonl':
+            self._stream.write(json.dumps(record) + '\n')
+        elif self._csv:
+            self._csv.writerow(record)
+        else:
+            line = f"{self._MARKS.get(record.get('change'), '')}{record['host']}: {record['proto'].upper()} port - " \
+                   f"{record['port']} - is {record['state']}."
+            if record['state'] == 'open':
+                line += f" {record['service']}"
+            if record.get('change') == 'changed':
+                line += f" (was {record['previous_state']} {record['previous_service']})".replace(' )', ')')
+            self._stream.write(line + '\n')
+
+    def flush(self):
+        self._stream.flush()
 
+    def close(self):
+        if self._stream is sys.stdout:
+            self.flush()
+        else:
+            self._stream.close()
+
+
+class Checkpoint:
+    """
+    Прогресс сканирования. Единица работы - пара (host, port), её номер - место в порядке обхода:
+    порт за портом, внутри порта хосты. Хранятся граница, ниже которой всё сделано, и сделанные номера выше неё,
+    поэтому продолжение начинается ровно с недоделанных единиц.
+    """
+    PARTS = 2  # единица сделана, когда завершились и TCP, и UDP проба
+
+    def __init__(self, path: str, hosts: list[str], start: int, end: int, output_format: str, output: str,
+                 next_unit: int = 0, done=()):
+        self.path = path
+        self.hosts = hosts
+        self.start = start
+        self.end = end
+        self.output_format = output_format
+        self.output = output
+        self._first = next_unit
+        self._skip = frozenset(done)
+        self._next = next_unit
+        self._done = set(done)
+        self._parts = {}  # номер единицы -> сколько её проб завершилось
+
+    def units(self):
+        """
+        :return: итератор (номер, номер хоста, порт) ещё не сделанных единиц в порядке обхода
+        """
+        total = (self.end - self.start + 1) * len(self.hosts)
+        for unit in range(self._first, total):
+            if unit not in self._skip:
+                yield unit, unit % len(self.hosts), self.start + unit // len(self.hosts)
+
+    def complete(self, unit: int) -> bool:
+        """
+        Отмечает завершение одной пробы единицы.
+        :return: True, если единица сделана целиком
+        """
+        parts = self._parts.pop(unit, 0) + 1
+        if parts < self.PARTS:
+            self._parts[unit] = parts
+            return False
+        self._done.add(unit)
+        while self._next in self._done:
+            self._done.remove(self._next)
+            self._next += 1
+        return True
+
+    def save(self):
+        state = dict(hosts=self.hosts, start=self.start, end=self.end, format=self.output_format,
+                     output=self.output, next=self._next, done=sorted(self._done))
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
-class POP3:
     @staticmethod
-    def is_pop3(packet: bytes) -> bool:
-        return packet.startswith(b'+')
+    def load(path: str) -> 'Checkpoint':
+        with open(path) as f:
+            state = json.load(f)
+        return Checkpoint(path, state['hosts'], state['start'], state['end'], state['format'], state['output'],
+                          state['next'], state['done'])
+
+
+class Probe:
+    """
+    Проба сервиса: что послать и на каких портах она вероятнее всего сработает.
+    """
+    __slots__ = ('name', 'payload', 'ports')
+
+    def __init__(self, name: str, payload: bytes, ports: tuple[int, ...] = ()):
+        self.name = name
+        self.payload = payload
+        self.ports = ports
+
+
+class Fingerprints:
+    """
+    Реестр проб и сигнатур сервисов. Сигнатуры собираются в одно регулярное выражение с именованными группами,
+    поэтому ответ сверяется со всеми протоколами за один проход, а имя сработавшей группы - имя протокола.
+    """
+
+    def __init__(self):
+        self._signatures = {}  # имя протокола -> регулярное выражение без захватывающих групп
+        self._probes = {'tcp': [], 'udp': []}
+        self._pattern = None
+
+    def signature(self, name: str, pattern: bytes):
+        """
+        Регистрирует сигнатуру. Сигнатуры проверяются в порядке регистрации, от начала ответа.
+        :param name: имя протокола, должно годиться в имя группы регулярного выражения
+        :param pattern: регулярное выражение, группы только (?:...)
+        """
+        self._signatures[name] = pattern
+        self._pattern = None
+
+    def probe(self, transport: str, probe: Probe):
+        """
+        Регистрирует пробу для 'tcp' или 'udp'. Пробы без подходящего порта идут в порядке регистрации.
+        """
+        self._probes[transport].append(probe)
+
+    def probes(self, transport: str, port: int) -> list[Probe]:
+        """
+        :return: пробы для порта, сначала те, что обычно работают на этом порту
+        """
+        probes = self._probes[transport]
+        return [probe for probe in probes if port in probe.ports] + \
+            [probe for probe in probes if port not in probe.ports]
+
+    def match(self, data: bytes) -> str:
+        """
+        :param data: ответ сервиса
+        :return: имя протокола или пустая строка
+        """
+        if self._pattern is None:
+            self._pattern = re.compile(b'|'.join(b'(?P<%s>%s)' % (name.encode(), pattern)
+                                                 for name, pattern in self._signatures.items()), re.DOTALL)
+        found = self._pattern.match(data)
+        return found.lastgroup if found else ''
+
+
+FINGERPRINTS = Fingerprints()
+FINGERPRINTS.signature('HTTP', rb'HTTP/\d\.\d \d{3}')
+FINGERPRINTS.signature('SSH', rb'SSH-\d\.\d+-')
+FINGERPRINTS.signature('FTP', rb'220[ -][^\r\n]*FTP')
+FINGERPRINTS.signature('SMTP', rb'[2-5]\d\d[ -]')
+FINGERPRINTS.signature('POP3', rb'\+OK|-ERR')
+FINGERPRINTS.signature('IMAP', rb'\* (?:OK|PREAUTH|BYE)')
+FINGERPRINTS.signature('REDIS', rb'\+PONG|-NOAUTH|-DENIED')
+# по TCP перед DNS-сообщением идут два байта длины; ответ - наш ID и выставленный бит QR
+FINGERPRINTS.signature('DNS', rb'(?:..)?' + re.escape(DNS_ID) + rb'[\x80-\xff]')
+# режим 4 (сервер) в младших битах первого байта и наш transmit timestamp в поле origin
+FINGERPRINTS.signature('SNTP', b'[' + re.escape(bytes(b for b in range(256) if b & 7 == 4)) + rb'].{23}' +
+                       re.escape(TIMESTAMP))
+FINGERPRINTS.probe('tcp', Probe('HTTP', b'GET / HTTP/1.0\r\n\r\n', (80, 81, 591, 8000, 8008, 8080, 8888)))
+FINGERPRINTS.probe('tcp', Probe('DNS', pack('!H', len(DNS_QUERY)) + DNS_QUERY, (53, 5353)))
+FINGERPRINTS.probe('tcp', Probe('REDIS', b'PING\r\n', (6379,)))
+FINGERPRINTS.probe('udp', Probe('DNS/SNTP', PACKET))
+FINGERPRINTS.probe('udp', Probe('DNS', DNS_QUERY, (53, 5353, 5355)))
+FINGERPRINTS.probe('udp', Probe('SNTP', SNTP_QUERY, (123,)))
+
+
+class UDPProbe(asyncio.DatagramProtocol):
+    """
+    Протокол для одной UDP-пробы: ждёт первый ответ или ошибку (например, ICMP «порт недоступен»).
+    """
 
+    def __init__(self, reply: asyncio.Future):
+        self.reply = reply
+
+    def datagram_received(self, data: bytes, address):
+        if not self.reply.done():
+            self.reply.set_result(data)
+
+    def error_received(self, exc: Exception):
+        if not self.reply.done():
+            self.reply.set_exception(exc)
+
+
+class UDPSweep:
+    """
+    Пакетное UDP-сканирование (только Linux): пробы на все порты всех хостов уходят через UDP_SOCKETS
+    несвязанных сокетов с IP_RECVERR. ICMP-ошибки ядро кладёт в очередь ошибок сокета (MSG_ERRQUEUE)
+    вместе с адресом, куда ушла проба, поэтому «порт недоступен» сразу закрывает нужный порт.
+    Повторно отправляются только пробы без ответа, каждый раз следующая из проб для порта,
+    порт, молчащий после всех повторов, - open|filtered.
+    """
+    _sent = METRICS.counter('probes.udp')
+    _retries = METRICS.counter('probes.udp.retries')
+    _outcomes = {state: METRICS.counter(f'probes.udp.{name}') for state, name in UDP_OUTCOMES.items()}
+    _rtt = METRICS.histogram('rtt.udp')
+
+    def __init__(self, window: int, limiter: RateLimiter, report):
+        """
+        :param report: вызывается как report(unit, record) для каждого порта, record - None для закрытого
+        """
+        self._window = window
+        self._limiter = limiter
+        self._report = report
+        self._sockets = []
+        self._local_ports = set()
+        self._pending = {}  # (host, port) -> [scanner, номер отправки, время отправки, отправленная проба, unit]
+        self._deadlines = []  # куча (срок, порядковый номер, (host, port), номер отправки)
+        self._order = itertools.count()
+        self._slot = asyncio.Event()
 
-class HTTP:
     @staticmethod
-    def is_http(packet: bytes) -> bool:
-        return b'HTTP' in packet
+    def supported() -> bool:
+        return sys.platform.startswith('linux')
 
+    async def run(self, probes):
+        """
+        Отправляет пробы, держа без ответа не больше window портов, и ждёт, пока все порты получат состояние.
+        :param probes: итератор (unit, scanner, port)
+        """
+        loop = asyncio.get_running_loop()
+        for _ in range(UDP_SOCKETS):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sockets.append(sock)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+            sock.bind(('', 0))
+            self._local_ports.add(sock.getsockname()[1])
+            loop.add_reader(sock.fileno(), self._receive, sock)
+        expiry = asyncio.ensure_future(self._expire())
+        try:
+            for unit, scanner, port in probes:
+                while len(self._pending) >= self._window:
+                    await self._wait()
+                await self._send(unit, scanner, port, 0)
+            while self._pending:
+                await self._wait()
+        finally:
+            expiry.cancel()
+            for sock in self._sockets:
+                loop.remove_reader(sock.fileno())
+                sock.close()
+            self._sockets.clear()
+
+    async def _wait(self):
+        self._slot.clear()
+        await self._slot.wait()
+
+    async def _send(self, unit: int, scanner: 'Scanner', port: int, attempt: int):
+        await self._limiter.wait()
+        key = (scanner.host, port)
+        probes = FINGERPRINTS.probes('udp', port)
+        payload = probes[attempt % len(probes)].payload
+        self._pending[key] = [scanner, attempt, time.monotonic(), payload, unit]
+        sock = self._sockets[port % len(self._sockets)]
+        self._sent.inc()
+        if attempt:
+            self._retries.inc()
+        failures = 0
+        while True:
+            try:
+                sock.sendto(payload, key)
+                break
+            except BlockingIOError:
+                await self._writable(sock)
+            except OSError:
+                # sendto вернул ошибку, пришедшую на прошлую пробу (возможно, к другому хосту), а эта проба
+                # не ушла; только повторная ошибка относится к ней самой
+                failures += 1
+                if failures >= UDP_SEND_ATTEMPTS:
+                    self._finish(key, 'filtered', timed=False)
+                    return
+        heapq.heappush(self._deadlines, (time.monotonic() + scanner.udp_timeout, next(self._order), key, attempt))
 
-class SMTP:
     @staticmethod
-    def is_smtp(packet: bytes) -> bool:
-        return packet[:3].isdigit()
+    async def _writable(sock: socket.socket):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_writer(sock.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_writer(sock.fileno())
+
+    async def _expire(self):
+        """
+        Повторная отправка проб, не получивших ни ответа, ни ICMP, за таймаут хоста.
+        """
+        while True:
+            while self._deadlines and self._deadlines[0][0] <= time.monotonic():
+                _, _, key, attempt = heapq.heappop(self._deadlines)
+                probe = self._pending.get(key)
+                if probe is None or probe[1] != attempt:
+                    continue
+                if attempt < UDP_RETRIES:
+                    await self._send(probe[4], probe[0], key[1], attempt + 1)
+                else:
+                    self._finish(key, 'open|filtered')
+            await asyncio.sleep(min(0.05, self._deadlines[0][0] - time.monotonic()) if self._deadlines else 0.05)
+
+    def _receive(self, sock: socket.socket):
+        while True:
+            try:
+                data, address = sock.recvfrom(1024)
+            except BlockingIOError:
+                break
+            except OSError:  # ошибка от ICMP, подробности ждут в очереди ошибок
+                continue
+            own = (address[0], sock.getsockname()[1])
+            if address[1] in self._local_ports and own in self._pending and data == self._pending[own][3]:
+                self._finish(own, 'closed')  # на localhost проба пришла в наш же сокет
+            else:
+                self._finish(address, 'open', data)
+        while True:
+            try:
+                _, ancdata, _, address = sock.recvmsg(1, 1024, MSG_ERRQUEUE)
+            except OSError:
+                break
+            for level, kind, payload in ancdata:
+                if level != socket.IPPROTO_IP or kind != IP_RECVERR:
+                    continue
+                _, origin, icmp_type, code, _ = EXTENDED_ERROR.unpack_from(payload)
+                if origin == SO_EE_ORIGIN_ICMP and icmp_type == ICMP_UNREACHABLE:
+                    self._finish(address, 'closed' if code == ICMP_PORT_UNREACHABLE else 'filtered')
+
+    def _finish(self, key: tuple[str, int], state: str, data: bytes = b'', timed: bool = True):
+        """
+        :param timed: False - проба не ушла, время до ответа не мерялось
+        """
+        probe = self._pending.pop(key, None)
+        if probe is None:
+            return
+        scanner, attempt, sent_at, _, unit = probe
+        self._outcomes[state].inc()
+        rtt = None
+        if timed and attempt == 0 and state != 'open|filtered':  # по повторам RTT не меряем, как в алгоритме Карна
+            rtt = time.monotonic() - sent_at
+            scanner.rtt.sample(rtt)
+            self._rtt.record(rtt)
+        self._report(unit, scanner.udp_record(key[1], state, data, rtt))
+        self._slot.set()
 
 
 class Scanner:
     """
     Класс Scanner создан для выполнения поставленной задачи.
     """
-    _PROTOCOL_DEFINER = {
-        'SMTP': lambda packet: SMTP.is_smtp(packet),
-        'DNS': lambda packet: DNS.is_dns(packet),
-        'POP3': lambda packet: POP3.is_pop3(packet),
-        'HTTP': lambda packet: HTTP.is_http(packet),
-        'SNTP': lambda packet: SNTP.is_sntp(packet)
-    }
+    _tcp_sent = METRICS.counter('probes.tcp')
+    _tcp_refused = METRICS.counter('probes.tcp.refused')
+    _tcp_timeouts = METRICS.counter('probes.tcp.timeouts')
+    _tcp_errors = METRICS.counter('probes.tcp.errors')
+    _tcp_rtt = METRICS.histogram('rtt.tcp')
+    _udp_sent = UDPSweep._sent
+    _udp_outcomes = UDPSweep._outcomes
+    _udp_rtt = UDPSweep._rtt
 
-    def __init__(self, host: str):
+    def __init__(self, host: str, window: asyncio.Semaphore, limiter: RateLimiter):
         self._host = host
+        self._window = window
+        self._limiter = limiter
+        self.rtt = RTTEstimator()
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @property
+    def udp_timeout(self) -> float:
+        return min(UDP_TIMEOUT, 2 * self.rtt.timeout)
+
+    async def _connect(self, sock: socket.socket, port: int) -> float | None:
+        """
+        TCP-соединение с портом с таймаутом по RTT хоста. Отказ (RST) тоже даёт замер RTT.
+        :return: время соединения, если порт открыт, иначе None
+        """
+        await self._limiter.wait()
+        self._tcp_sent.inc()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (self._host, port)), self.rtt.timeout)
+        except ConnectionRefusedError:
+            rtt = time.monotonic() - started
+            self.rtt.sample(rtt)
+            self._tcp_refused.inc()
+            self._tcp_rtt.record(rtt)
+            return None
+        except asyncio.TimeoutError:
+            self._tcp_timeouts.inc()
+            return None
+        except OSError:
+            self._tcp_errors.inc()
+            return None
+        rtt = time.monotonic() - started
+        self.rtt.sample(rtt)
+        self._tcp_rtt.record(rtt)
+        if sock.getsockname() == sock.getpeername():  # на localhost сокет может соединиться сам с собой
+            return None
+        return rtt
+
+    async def is_up(self) -> bool:
+        """
+        Обнаружение хоста: он жив, если хоть один из DISCOVERY_PORTS ответил SYN-ACK или RST.
+        Заодно даёт первые замеры RTT.
+        """
+        async def probe(port: int) -> bool:
+            async with self._window:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                    sock.setblocking(False)
+                    await self._connect(sock, port)
+            return self.rtt.srtt is not None
+
+        return any(await asyncio.gather(*(probe(port) for port in DISCOVERY_PORTS)))
 
-    def tcp_port(self, port: int) -> str:
+    async def tcp_port(self, port: int) -> dict | None:
         """
         Проверка доступности (открытости) TCP порта.
         :param port: port (int())
-        :return: if port is open, returns the message of open port
+        :return: if port is open, returns the record of open port
         (and maybe protocol name which is working on port),
-        else empty string
+        else None
         """
-        socket.setdefaulttimeout(0.5)
-        result = ''
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        async with self._window:
+            sock = self._tcp_socket()
             try:
-                sock.connect((self._host, port))
-                result = f'TCP port - {port} - is open.'
-            except (socket.timeout, TimeoutError, OSError):
-                pass
-            try:
-                sock.send(pack('!H', len(PACKET)) + PACKET)
-                data = sock.recv(1024)
-                result += f' {self._check(data)}'
-            except socket.error:
-                pass
-        return result
+                rtt = await self._connect(sock, port)
+                if rtt is None:
+                    return None
+                service = FINGERPRINTS.match(await self._receive(sock))
+                return self._record('tcp', port, 'open', service or await self._probe(sock, port), rtt)
+            finally:
+                sock.close()
+
+    async def _probe(self, sock: socket.socket, port: int) -> str:
+        """
+        Сервис молчит после соединения: посылаем пробы, самые вероятные для порта первыми,
+        каждую следующую - в новом соединении.
+        :param sock: соединение, в котором баннера не было
+        :return: имя протокола или пустая строка
+        """
+        try:
+            for number, probe in enumerate(FINGERPRINTS.probes('tcp', port)[:TCP_PROBES]):
+                if number:
+                    sock.close()
+                    sock = self._tcp_socket()
+                    if await self._connect(sock, port) is None:
+                        break
+                try:
+                    await asyncio.get_running_loop().sock_sendall(sock, probe.payload)
+                except OSError:
+                    continue
+                service = FINGERPRINTS.match(await self._receive(sock))
+                if service:
+                    return service
+            return ''
+        finally:
+            sock.close()
+
+    async def _receive(self, sock: socket.socket) -> bytes:
+        try:
+            return await asyncio.wait_for(asyncio.get_running_loop().sock_recv(sock, 1024),
+                                          max(TCP_TIMEOUT, self.rtt.timeout))
+        except (asyncio.TimeoutError, OSError):
+            return b''
+
+    @staticmethod
+    def _tcp_socket() -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        return sock
 
-    def udp_port(self, port: int) -> str:
+    async def udp_port(self, port: int) -> dict | None:
         """
-        Проверка доступности (открытости) UDP порта.
+        Проверка доступности (открытости) UDP порта, когда пакетный режим UDPSweep недоступен.
+        Сокет подключён к порту, поэтому ICMP «порт недоступен» завершает проверку сразу, без ожидания таймаута.
         :param port: port (int())
-        :return: if port is open, returns the message of open port
+        :return: if port is open, returns the record of open port
         (and maybe protocol name which is working on port),
-        else empty string
+        if nothing came back, the open|filtered record, else None
         """
-        socket.setdefaulttimeout(3)
-        result = ''
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        async with self._window:
+            loop = asyncio.get_running_loop()
             try:
-                sock.sendto(PACKET, (self._host, port))
-                data, _ = sock.recvfrom(1024)
-                result = f'UDP port - {port} - is open. {self._check(data)}'
-            except socket.error:
-                pass
-        return result
+                transport, protocol = await loop.create_datagram_endpoint(
+                    lambda: UDPProbe(loop.create_future()), remote_addr=(self._host, port))
+            except OSError:
+                return None
+            if transport.get_extra_info('sockname') == transport.get_extra_info('peername'):
+                transport.close()
+                return None
+            try:
+                await self._limiter.wait()
+                self._udp_sent.inc()
+                started = time.monotonic()
+                transport.sendto(FINGERPRINTS.probes('udp', port)[0].payload)
+                data = await asyncio.wait_for(protocol.reply, self.udp_timeout)
+                rtt = time.monotonic() - started
+                self._udp_outcomes['open'].inc()
+                self._udp_rtt.record(rtt)
+                return self._record('udp', port, 'open', FINGERPRINTS.match(data), rtt)
+            except asyncio.TimeoutError:
+                self._udp_outcomes['open|filtered'].inc()
+                return self.udp_record(port, 'open|filtered')
+            except OSError:
+                self._udp_outcomes['closed'].inc()
+                return None
+            finally:
+                transport.close()
 
-    def _check(self, data: bytes) -> str:
+    def udp_record(self, port: int, state: str, data: bytes = b'', rtt: float = None) -> dict | None:
         """
-        Проверка соответствие одному из данных протоколов
-        :param data: stream of data bytes
-        :return: name of protocol (str()) if it's found else empty string ('')
+        Запись о состоянии UDP порта из пакетного режима.
+        :param state: open, closed, filtered или open|filtered
+        :param data: ответ с порта, если он был
+        :return: запись или None для закрытого порта
         """
-        for protocol, checker in self._PROTOCOL_DEFINER.items():
-            if checker(data):
-                return protocol
-        return ''
+        if state == 'closed':
+            return None
+        return self._record('udp', port, state, FINGERPRINTS.match(data) if state == 'open' else '', rtt)
+
+    def _record(self, proto: str, port: int, state: str, service: str, rtt: float | None) -> dict:
+        return dict(host=self._host, port=port, proto=proto, state=state, service=service,
+                    rtt=None if rtt is None else round(rtt * 1000, 3))
+
+
+def main(hosts: list[str], start: int, end: int, concurrency: int = DEFAULT_CONCURRENCY, rate: float = 0,
+         discovery: bool = True, output_format: str = 'text', output: str = None,
+         checkpoint: str = CHECKPOINT_FILE, resume: bool = False, baseline: str = None,
+         sample: float = DEFAULT_SAMPLE, full: bool = False):
+    if baseline:
+        try:
+            previous = Output.read(baseline)
+        except (OSError, ValueError, KeyError):
+            print(f'Cannot read baseline {baseline}')
+            sys.exit()
+        writer = Output.open(output, output_format, changes=True)
+        try:
+            asyncio.run(rescan(previous, hosts, start, end, limit_concurrency(concurrency), rate, sample, full,
+                               writer))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            writer.close()
+        return
+    if resume:
+        try:
+            progress = Checkpoint.load(checkpoint)
+        except (OSError, ValueError, KeyError):
+            print(f'Cannot read checkpoint {checkpoint}')
+            sys.exit()
+    else:
+        progress = Checkpoint(checkpoint, hosts, start, end, output_format, output)
+    writer = Output.open(progress.output, progress.output_format, append=resume)
+    try:
+        asyncio.run(scan(progress, limit_concurrency(concurrency), rate, discovery and not resume, writer))
+    except KeyboardInterrupt:
+        print(f'Interrupted, continue with --resume --checkpoint {checkpoint}', file=sys.stderr)
+    finally:
+        writer.close()
+
+
+async def probe_units(units, concurrency: int, limiter: RateLimiter, report):
+    """
+    Проверяет TCP и UDP порты единиц работы пулом из concurrency задач, каждая берёт очередную пробу
+    из общего итератора, так что одновременно открыто не больше concurrency сокетов.
+    UDP на Linux сканируется отдельно, пакетно (UDPSweep).
+    :param units: функция, возвращающая итератор (unit, scanner, port); вызывается по разу на TCP и на UDP
+    :param report: вызывается как report(unit, record) по завершении каждой пробы, record - None для закрытого порта
+    """
+    if UDPSweep.supported():
+        sweeps = [UDPSweep(concurrency, limiter, report).run(units())]
+        kinds = [Scanner.tcp_port]
+    else:
+        sweeps = []
+        kinds = [Scanner.tcp_port, Scanner.udp_port]
+    probes = ((probe, unit, scanner, port) for unit, scanner, port in units() for probe in kinds)
+
+    async def worker():
+        for probe, unit, scanner, port in probes:
+            report(unit, await probe(scanner, port))
 
+    await asyncio.gather(*sweeps, *(worker() for _ in range(concurrency)))
 
-def main(host: str, start: int, end: int):
-    with ThreadPoolExecutor(max_workers=500) as pool:
+
+async def scan(progress: Checkpoint, concurrency: int, rate: float, discovery: bool, output: Output):
+    """
+    Сканирование единиц работы из контрольной точки. Пробы чередуются между хостами: сначала порт start
+    на всех хостах, затем следующий, поэтому ни один хост не получает всю нагрузку. Каждые CHECKPOINT_INTERVAL
+    секунд вывод сбрасывается на диск, а прогресс - в файл контрольной точки, после полного завершения файл удаляется.
+    """
+    window = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate)
+    scanners = [Scanner(host, window, limiter) for host in progress.hosts]
+    if discovery:
+        alive = await asyncio.gather(*(scanner.is_up() for scanner in scanners))
+        scanners = [scanner for scanner, is_up in zip(scanners, alive) if is_up]
+        progress.hosts = [scanner.host for scanner in scanners]
+    held = {}  # unit -> записи, ждущие завершения остальных проб единицы
+    stopped = False
+
+    def report(unit: int, record: dict | None):
+        # записи единицы выводятся разом, когда она сделана, так что вывод и контрольная точка согласованы
+        if stopped:  # gather отменён, но пробы ещё доделываются, а контрольная точка уже записана
+            return
+        if record:
+            held.setdefault(unit, []).append(record)
+        if progress.complete(unit):
+            for record in held.pop(unit, ()):
+                output.write(record)
+
+    async def save():
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            output.flush()
+            progress.save()
+
+    saver = asyncio.ensure_future(save())
+    try:
+        await probe_units(lambda: ((unit, scanners[host], port) for unit, host, port in progress.units()),
+                          concurrency, limiter, report)
+    except BaseException:
+        stopped = True
+        output.flush()
+        progress.save()
+        raise
+    finally:
+        saver.cancel()
+    output.flush()
+    progress.remove()
+
+
+async def rescan(baseline: dict, hosts: list[str], start: int, end: int, concurrency: int, rate: float,
+                 sample: float, full: bool, output: Output):
+    """
+    Пересканирование относительно прошлых результатов. Сначала проверяются порты, о которых есть записи
+    в baseline, и случайная доля sample остальных, затем, если full, весь остальной диапазон с окном
+    в BACKGROUND_SHARE раз меньше. Выводятся только изменения: открылся, закрылся, сменились состояние или сервис.
+    :param baseline: словарь (host, port, proto) -> (state, service), см. Output.read
+    """
+    window = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate)
+    scanners = {host: Scanner(host, window, limiter) for host in hosts}
+    known = {(host, port) for host, port, _ in baseline if host in scanners and start <= port <= end}
+    seed = random.getrandbits(64)
+    found = {}  # (host, port) -> {proto: record}
+    finished = {}  # (host, port) -> сколько проб завершилось
+
+    def report(target: tuple[str, int], record: dict | None):
+        if record:
+            found.setdefault(target, {})[record['proto']] = record
+        finished[target] = finished.get(target, 0) + 1
+        if finished[target] < Checkpoint.PARTS:
+            return
+        del finished[target]
+        records = found.pop(target, {})
+        for proto in ('tcp', 'udp'):
+            change = diff(target, proto, records.get(proto), baseline.get((*target, proto)))
+            if change:
+                output.write(change)
+
+    def targets(sampled: bool):
+        """
+        Цели по порядку (порт, хост) без списков в памяти. Выборка решается по каждой цели генератором
+        с одним и тем же seed, поэтому каждый обход, и на TCP, и на UDP, и остаток при full, видит ту же выборку.
+        :param sampled: True - известные и попавшие в выборку цели, False - остальные
+        """
+        chance = random.Random(seed)
         for port in range(start, end + 1):
-            pool.submit(execute, Scanner(host), port)
+            for host in hosts:
+                target = (host, port)
+                if (target in known or chance.random() < sample) == sampled:
+                    yield target, scanners[host], port
+
+    await probe_units(lambda: targets(True), concurrency, limiter, report)
+    output.flush()
+    if full:
+        await probe_units(lambda: targets(False), max(1, concurrency // BACKGROUND_SHARE), limiter, report)
+        output.flush()
 
 
-def execute(scanner: Scanner, port: int):
-    show(scanner.tcp_port(port))
-    show(scanner.udp_port(port))
+def diff(target: tuple[str, int], proto: str, record: dict | None, previous: tuple[str, str] | None) -> dict | None:
+    """
+    :param record: запись о порте сейчас, None - порт закрыт
+    :param previous: (state, service) из прошлого сканирования, None - порт был закрыт
+    :return: запись об изменении или None
+    """
+    if record is None and previous is None:
+        return None
+    if record is None:
+        record = dict(host=target[0], port=target[1], proto=proto, state='closed', service='', rtt=None)
+        change = 'closed'
+    elif previous is None:
+        change = 'opened'
+    elif (record['state'], record['service']) != previous:
+        change = 'changed'
+    else:
+        return None
+    previous_state, previous_service = previous or ('closed', '')
+    return dict(record, change=change, previous_state=previous_state, previous_service=previous_service)
 
 
-def show(result: str):
-    if result:
-        print(result)
+def limit_concurrency(concurrency: int) -> int:
+    """
+    Поднимает мягкий лимит открытых файлов до жёсткого и урезает окно, если дескрипторов всё равно не хватает.
+    :param concurrency: желаемое число одновременных проб
+    :return: допустимое число одновременных проб
+    """
+    if resource is None:
+        return concurrency
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return concurrency
+    return max(1, min(concurrency, soft - RESERVED_DESCRIPTORS))
 
 
 if __name__ == "__main__":
     a = Arguments()
-    main(a.host, a.start, a.end)
+    with Reporter(METRICS, **a.reporting):
+        main(a.hosts, a.start, a.end, a.concurrency, a.rate, a.discovery, a.output_format, a.output, a.checkpoint,
+             a.resume, a.baseline, a.sample, a.full)
@@ -1,11 +1,50 @@
 import re
+import socket
+import struct
 import subprocess
-from json import loads
-from urllib import request
+import sys
+import time
+import asyncio
+import http.client
+import ipaddress
+import mmap
+import os
+import queue
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from json import loads, dump, load
+from urllib.parse import urlsplit
 import argparse
 
 ip_regex = re.compile(r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})')
 
+MAX_HOPS = 30
+TIMEOUT = 3  # ждём ответы на все пробы не дольше, считая от их отправки
+BASE_PORT = 33434  # UDP-проба с TTL n уходит на порт BASE_PORT + n, как в классическом traceroute
+PROBE_RATE = 200  # проб в секунду на все цели пакетной трассировки
+BATCH_CONCURRENCY = 16
+START_TTL = 8  # с этого TTL пакетная трассировка идёт вперёд, ближние узлы - назад до уже известных
+WINDOW = 4  # сколько TTL пробуется разом при движении вперёд
+GAP_LIMIT = 5  # после стольких молчащих узлов подряд трассировка цели прекращается
+IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)  # значения из linux/in.h и linux/socket.h,
+MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)  # в модуле socket их может не быть
+SO_EE_ORIGIN_ICMP = 2
+EXTENDED_ERROR = struct.Struct('=IBBBBII')  # struct sock_extended_err, за ней sockaddr_in ответившего узла
+ICMP_ECHO_REPLY = 0
+ICMP_UNREACHABLE = 3
+ICMP_ECHO = 8
+ICMP_TIME_EXCEEDED = 11
+AS_ENDPOINT = 'https://ipinfo.io/{ip}/json'
+AS_CACHE_FILE = 'as_cache.json'
+AS_CACHE_TTL = 7 * 24 * 3600  # принадлежность адресов к AS меняется редко
+AS_POOL_SIZE = 8
+AS_TIMEOUT = 5
+AS_INDEX_MAGIC = b'ASIX\x01'
+AS_INDEX_HEADER = struct.Struct('!5sIII')  # magic, число узлов, число значений, размер строк
+AS_INDEX_NODE = struct.Struct('!IBxxxIII')  # префикс, его длина, левый и правый потомок, номер значения + 1
+AS_INDEX_VALUE = struct.Struct('!I2sIH')  # ASN, страна, смещение и длина названия организации
+NO_CHILD = 0xFFFFFFFF
+
 phrases = {
     'ii': 'Не удается разрешить системное имя узла.\n',
     'tr': 'Трассировка маршрута',
@@ -35,7 +74,7 @@ class ASResponse:
         self.country = self._json.get('country') or '--'
         org = self._json.get('org')
         self.AS = '--' if org is None else org.split()[0]
-        self.provider = '--' if org is None else ' '.join(org.split()[1:])
+        self.provider = '--' if org is None else ' '.join(org.split()[1:]) or '--'
 
 
 class Output:
@@ -87,18 +126,656 @@ class Output:
         return ' ' * (3 + (expected - actual))
 
 
-def get_as_number_by_ip(ip) -> ASResponse:
+class Tracer:
     """
-    По полученному ip-адресу вернуть объект отклика.
-    :param ip:
-    :return: ASResponse
+    Параллельная трассировка для Linux: пробы со всеми TTL от 1 до max_hops уходят разом из одного сокета
+    с IP_RECVERR, а ICMP «время истекло» и «недоступен» ядро кладёт в очередь ошибок сокета, откуда они
+    читаются без привилегий. Через половину таймаута пробы на ещё не ответившие узлы посылаются повторно.
+    Трассировка занимает около одного RTT плюс таймаут для молчащих узлов.
+    UDP-пробы различаются портом назначения, ICMP echo (ping-сокет) - номером последовательности.
     """
-    return ASResponse(loads(request.urlopen('https://ipinfo.io/' + ip + '/json').read()))
 
+    def __init__(self, destination: str, protocol: str = 'udp', max_hops: int = MAX_HOPS, timeout: float = TIMEOUT,
+                 on_hop=None, budget: 'ProbeBudget' = None):
+        """
+        :param destination: IP-адрес цели
+        :param protocol: udp или icmp
+        :param on_hop: вызывается как on_hop(ttl, ip) сразу при ответе узла, в любом порядке
+        :param budget: общий предел частоты проб, если трассировок несколько
+        """
+        self._destination = destination
+        self._protocol = protocol
+        self._max_hops = max_hops
+        self._timeout = timeout
+        self._on_hop = on_hop
+        self._budget = budget
+        self._sock = None
+        self._hops = {}  # ttl -> (ip, rtt)
+        self._sent = {}  # ttl -> время отправки
+        self._reached = max_hops  # TTL, на котором ответила цель или узел, сообщивший о недоступности
+        self._changed = asyncio.Event()
+        self.probes = 0
+
+    @staticmethod
+    def supported() -> bool:
+        return sys.platform.startswith('linux')
 
-def get_route(address: str):
+    @property
+    def reached(self) -> int:
+        return self._reached
+
+    def start(self):
+        self._sock = self._open()
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._receive, self._sock)
+
+    def stop(self):
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+
+    async def trace(self):
+        """
+        Асинхронный генератор узлов по порядку TTL: (ttl, ip, rtt), для промолчавшего узла ip и rtt - None.
+        Узел отдаётся, как только ответили он и все ближние к нам узлы.
+        """
+        loop = asyncio.get_running_loop()
+        self.start()
+        try:
+            await self._send_many(range(1, self._max_hops + 1))
+            deadline = loop.time() + self._timeout
+            resend_at = loop.time() + self._timeout / 2
+            ttl = 1
+            while ttl <= self._reached:
+                if ttl in self._hops or loop.time() >= deadline:
+                    yield ttl, *self._hops.get(ttl, (None, None))
+                    ttl += 1
+                    continue
+                if loop.time() >= resend_at:
+                    # узлы ограничивают частоту ICMP, и из пачки проб ответ приходит не на все
+                    await self._send_many([missing for missing in range(ttl, self._reached + 1)
+                                           if missing not in self._hops])
+                    resend_at = deadline
+                await self._wait(min(resend_at, deadline) - loop.time())
+        finally:
+            self.stop()
+
+    async def probe(self, ttls) -> dict:
+        """
+        Пробует только заданные TTL (сокет открыт start()) и ждёт их ответов не дольше таймаута,
+        с повтором через половину таймаута.
+        :return: словарь ttl -> ip ответивших узлов; TTL дальше цели не ждутся
+        """
+        loop = asyncio.get_running_loop()
+        ttls = list(ttls)
+        await self._send_many([ttl for ttl in ttls if ttl not in self._hops])
+        deadline = loop.time() + self._timeout
+        resend_at = loop.time() + self._timeout / 2
+        while missing := [ttl for ttl in ttls if ttl not in self._hops and ttl <= self._reached]:
+            if loop.time() >= deadline:
+                break
+            if loop.time() >= resend_at:
+                await self._send_many(missing)
+                resend_at = deadline
+            await self._wait(min(resend_at, deadline) - loop.time())
+        return {ttl: self._hops[ttl][0] for ttl in ttls if ttl in self._hops}
+
+    async def _wait(self, timeout: float):
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _send_many(self, ttls):
+        for ttl in ttls:
+            if self._budget:
+                await self._budget.acquire()
+            self._send(self._sock, ttl)
+
+    def _send(self, sock: socket.socket, ttl: int):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+        if self._protocol == 'icmp':
+            probe, address = struct.pack('!BBHHH', ICMP_ECHO, 0, 0, 0, ttl), (self._destination, 0)
+        else:
+            probe, address = b'', (self._destination, BASE_PORT + ttl)
+        self._sent[ttl] = time.monotonic()
+        self.probes += 1
+        try:
+            sock.sendto(probe, address)
+        except OSError:  # sendto вернул ошибку, пришедшую на прошлую пробу, а эта проба не ушла
+            sock.sendto(probe, address)
+
+    def _open(self) -> socket.socket:
+        if self._protocol == 'icmp':
+            # ping-сокет без root, если группа пользователя входит в net.ipv4.ping_group_range
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+        return sock
+
+    def _receive(self, sock: socket.socket):
+        while True:  # эхо-ответы цели (ICMP), по UDP цель отвечает ошибкой «порт недоступен»
+            try:
+                data, address = sock.recvfrom(1024)
+            except BlockingIOError:
+                break
+            except OSError:  # ошибка, подробности в очереди ошибок
+                continue
+            if self._protocol == 'icmp' and len(data) >= 8 and data[0] == ICMP_ECHO_REPLY:
+                self._hop(struct.unpack_from('!H', data, 6)[0], address[0], True)
+        while True:
+            try:
+                data, ancdata, _, address = sock.recvmsg(64, 1024, MSG_ERRQUEUE)
+            except OSError:
+                break
+            for level, kind, payload in ancdata:
+                if level != socket.IPPROTO_IP or kind != IP_RECVERR:
+                    continue
+                _, origin, icmp_type, _, _, _, _ = EXTENDED_ERROR.unpack_from(payload)
+                if origin != SO_EE_ORIGIN_ICMP or icmp_type not in (ICMP_TIME_EXCEEDED, ICMP_UNREACHABLE):
+                    continue
+                offender = socket.inet_ntoa(payload[EXTENDED_ERROR.size + 4:EXTENDED_ERROR.size + 8])
+                if self._protocol == 'icmp':  # ядро возвращает заголовок нашего echo из ICMP-ошибки
+                    if len(data) < 8:
+                        continue
+                    ttl = struct.unpack_from('!H', data, 6)[0]
+                else:
+                    ttl = address[1] - BASE_PORT
+                self._hop(ttl, offender, icmp_type == ICMP_UNREACHABLE)
+
+    def _hop(self, ttl: int, ip: str, last: bool):
+        if ttl not in self._sent or ttl in self._hops:
+            return
+        self._hops[ttl] = (ip, time.monotonic() - self._sent[ttl])
+        if last:
+            self._reached = min(self._reached, ttl)
+        if self._on_hop:
+            self._on_hop(ttl, ip)
+        self._changed.set()
+
+
+class ProbeBudget:
+    """
+    Общий для всех трассировок предел частоты проб (token bucket): маршрутизаторы ограничивают ICMP,
+    а лавина проб к сотням целей похожа на сканирование.
+    """
+
+    def __init__(self, rate: float):
+        """
+        :param rate: проб в секунду; допускается всплеск в десятую долю секунды
+        """
+        self._rate = rate
+        self._burst = max(1.0, rate / 10)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class BatchTracer:
+    """
+    Трассировка многих целей сразу по схеме Doubletree. Для каждой цели пробы идут вперёд окнами по WINDOW
+    TTL, начиная со start_ttl, до цели или GAP_LIMIT молчащих узлов подряд, затем назад от start_ttl - 1.
+    Движение назад останавливается на первом узле из стоп-множества - узле, путь до которого уже известен
+    по другой цели: ближние к нам узлы у маршрутов общие, и они не пробуются заново. Все трассировки делят
+    один предел частоты проб. Результат - маршруты целей, объединённые в граф.
+    """
+
+    def __init__(self, protocol: str = 'udp', max_hops: int = MAX_HOPS, timeout: float = TIMEOUT,
+                 rate: float = PROBE_RATE, concurrency: int = BATCH_CONCURRENCY, start_ttl: int = START_TTL,
+                 on_hop=None):
+        """
+        :param rate: проб в секунду на все цели
+        :param concurrency: сколько целей трассируется одновременно
+        :param on_hop: вызывается как on_hop(ttl, ip) при ответе каждого узла
+        """
+        self._protocol = protocol
+        self._max_hops = max_hops
+        self._timeout = timeout
+        self._budget = ProbeBudget(rate)
+        self._concurrency = concurrency
+        self._start_ttl = min(start_ttl, max_hops)
+        self._on_hop = on_hop
+        self._known = {}  # стоп-множество: ip -> путь от нас до него включительно
+        self.routes = {}  # цель -> список IP узлов по TTL, None - узел промолчал
+        self.probes = 0
+        self.skipped = 0  # столько узлов взято из стоп-множества вместо проб
+
+    async def trace(self, destinations: dict) -> dict:
+        """
+        :param destinations: словарь имя цели -> её IP-адрес
+        :return: словарь имя цели -> маршрут
+        """
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def trace_one(name: str, destination: str):
+            async with semaphore:
+                self.routes[name] = await self._trace(destination)
+
+        await asyncio.gather(*(trace_one(name, destination) for name, destination in destinations.items()))
+        return self.routes
+
+    async def _trace(self, destination: str) -> list:
+        tracer = Tracer(destination, self._protocol, self._max_hops, self._timeout, self._on_hop, self._budget)
+        tracer.start()
+        try:
+            hops = {}
+            ttl, silent = self._start_ttl, 0
+            while ttl <= tracer.reached and silent < GAP_LIMIT:
+                window = range(ttl, min(ttl + WINDOW, tracer.reached + 1))
+                hops.update(await tracer.probe(window))
+                for probed in window:
+                    silent = 0 if probed in hops else silent + 1
+                ttl += WINDOW
+            # маршрут кончается целью или последним ответившим узлом
+            last = tracer.reached if tracer.reached in hops else max(hops, default=self._start_ttl - 1)
+            known = ()
+            for ttl in range(min(self._start_ttl, last + 1) - 1, 0, -1):
+                hops.update(await tracer.probe([ttl]))
+                path = self._known.get(hops.get(ttl))
+                if path and len(path) == ttl:  # тот же узел на том же расстоянии - путь до него уже пройден
+                    known = path
+                    self.skipped += ttl - 1
+                    break
+            if tracer.reached in hops:  # при движении назад цель могла ответить ближе
+                last = tracer.reached
+        finally:
+            tracer.stop()
+        self.probes += tracer.probes
+        route = list(known) + [hops.get(ttl) for ttl in range(len(known) + 1, last + 1)]
+        for number, ip in enumerate(route):
+            if ip is not None and ip not in self._known:
+                self._known[ip] = tuple(route[:number + 1])
+        return route
+
+    def graph(self) -> tuple[list[str], list[tuple[str, str]]]:
+        """
+        :return: узлы в порядке первого появления на маршрутах и рёбра между соседними ответившими узлами
+        """
+        nodes, edges = {}, {}
+        for route in self.routes.values():
+            for previous, ip in zip([None] + route, route):
+                if ip is not None:
+                    nodes[ip] = None
+                    if previous is not None and previous != ip:
+                        edges[previous, ip] = None
+        return list(nodes), list(edges)
+
+
+class ASLookup:
+    """
+    Поиск AS по IP через HTTP-сервис (по умолчанию ipinfo.io): до pool_size запросов идут параллельно
+    по постоянным keep-alive соединениям, ответы хранятся в файловом кэше ttl секунд.
+    Частные и зарезервированные адреса в сервис не отправляются.
+    """
+
+    def __init__(self, endpoint: str = AS_ENDPOINT, cache_file: str = AS_CACHE_FILE, ttl: float = AS_CACHE_TTL,
+                 pool_size: int = AS_POOL_SIZE):
+        """
+        :param endpoint: URL с подстановкой {ip}, например http://127.0.0.1:8000/{ip}/json
+        :param cache_file: файл кэша, None - не сохранять кэш
+        """
+        parts = urlsplit(endpoint)
+        self._https = parts.scheme == 'https'
+        self._netloc = parts.netloc
+        self._path = endpoint[endpoint.index(parts.netloc) + len(parts.netloc):] or '/'
+        self._cache_file = cache_file
+        self._ttl = ttl
+        self._cache = self._load()  # ip -> [срок годности, json]
+        self._idle = queue.SimpleQueue()  # свободные соединения
+        self.executor = ThreadPoolExecutor(pool_size, thread_name_prefix='as-lookup')
+
+    def get(self, ip: str) -> ASResponse:
+        """
+        По полученному ip-адресу вернуть объект отклика. Блокирующий вызов, для параллельных
+        запросов выполняется в self.executor.
+        """
+        try:
+            if not ipaddress.ip_address(ip).is_global:
+                return ASResponse({'ip': ip, 'bogon': True})
+        except ValueError:
+            return ASResponse({'ip': ip})
+        cached = self._cache.get(ip)
+        if cached and cached[0] > time.time():
+            return ASResponse(cached[1])
+        try:
+            json = self._request(ip)
+        except (OSError, ValueError, http.client.HTTPException):
+            return ASResponse({'ip': ip})
+        self._cache[ip] = [time.time() + self._ttl, json]
+        return ASResponse(json)
+
+    def get_many(self, ips: list[str]) -> dict:
+        """
+        :return: словарь ip -> ASResponse, запросы идут параллельно
+        """
+        ips = list(dict.fromkeys(ips))
+        return dict(zip(ips, self.executor.map(self.get, ips)))
+
+    def submit(self, ip: str) -> Future:
+        return self.executor.submit(self.get, ip)
+
+    def _request(self, ip: str) -> dict:
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            connection = connection_class(self._netloc, timeout=AS_TIMEOUT)
+        try:
+            for attempt in range(2):
+                try:
+                    connection.request('GET', self._path.replace('{ip}', ip), headers={'Accept': 'application/json'})
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    connection.close()  # сервер мог закрыть простаивавшее соединение, второй раз откроется новое
+                    if attempt:
+                        raise
+            if response.status != 200:
+                raise ValueError(f'{response.status} {response.reason}')
+            return loads(body)
+        finally:
+            self._idle.put(connection)
+
+    def _load(self) -> dict:
+        if not self._cache_file:
+            return {}
+        try:
+            with open(self._cache_file) as f:
+                return {ip: entry for ip, entry in load(f).items() if entry[0] > time.time()}
+        except (OSError, ValueError, AttributeError, TypeError, IndexError):
+            return {}
+
+    def close(self):
+        """
+        Сохраняет кэш и закрывает соединения.
+        """
+        self.executor.shutdown()
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+        if not self._cache_file:
+            return
+        now = time.time()
+        with open(self._cache_file + '.tmp', 'w') as f:
+            dump({ip: entry for ip, entry in self._cache.items() if entry[0] > now}, f)
+        os.replace(self._cache_file + '.tmp', self._cache_file)
+
+
+class ASIndex:
+    """
+    Офлайн-поиск AS по локальной выгрузке префиксов: формат pyasn («1.0.0.0/24<TAB>13335») или ip2asn-v4.tsv
+    с iptoasn.com («начало<TAB>конец<TAB>ASN<TAB>страна<TAB>организация»). Префиксы собираются в сжатое
+    двоичное дерево (Patricia) в файле индекса, который затем только отображается в память, так что запуск
+    не читает выгрузку. Самый длинный совпадающий префикс ищется проходом не более чем по 32 узлам.
+    """
+
+    def __init__(self, source: str):
+        """
+        :param source: выгрузка префиксов или готовый индекс; индекс source + '.idx' строится,
+        если его нет или он старше выгрузки
+        """
+        path = source if self.is_index(source) else self.build(source)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, nodes, values, _ = AS_INDEX_HEADER.unpack_from(self._map)
+        self._values = AS_INDEX_HEADER.size + nodes * AS_INDEX_NODE.size
+        self._strings = self._values + values * AS_INDEX_VALUE.size
+
+    @staticmethod
+    def is_index(path: str) -> bool:
+        with open(path, 'rb') as f:
+            return f.read(len(AS_INDEX_MAGIC)) == AS_INDEX_MAGIC
+
+    @staticmethod
+    def build(source: str, index: str = None) -> str:
+        """
+        Строит индекс, если его ещё нет или выгрузка новее.
+        :return: путь к индексу
+        """
+        index = index or source + '.idx'
+        if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(source):
+            return index
+        values = {}  # (asn, страна, организация) -> номер + 1
+        prefixes = {}  # (адрес, длина) -> номер значения + 1
+        for network, value in ASIndex._read(source):
+            prefixes[int(network.network_address), network.prefixlen] = values.setdefault(value, len(values) + 1)
+        items = sorted(prefixes.items())
+        bits = [address for (address, _), _ in items]
+        nodes = bytearray()
+
+        def make(low: int, high: int, prefix: int, length: int) -> int:
+            """
+            Узел для items[low:high], у всех них первые length бит равны prefix. Узлы без значения
+            с одним потомком пропускаются - это и есть сжатие путей.
+            """
+            while True:
+                value = 0
+                if low < high and items[low][0] == (prefix, length):
+                    value = items[low][1]
+                    low += 1
+                middle = bisect_left(bits, prefix | 1 << 31 - length, low, high) if length < 32 else high
+                if value or length == 32 or low < middle < high or low == high:
+                    break
+                if middle == high:  # все префиксы с нулевым следующим битом
+                    length += 1
+                else:
+                    prefix, length = prefix | 1 << 31 - length, length + 1
+            number = len(nodes) // AS_INDEX_NODE.size
+            nodes.extend(bytes(AS_INDEX_NODE.size))
+            left = make(low, middle, prefix, length + 1) if low < middle else NO_CHILD
+            right = make(middle, high, prefix | 1 << 31 - length, length + 1) if middle < high else NO_CHILD
+            AS_INDEX_NODE.pack_into(nodes, number * AS_INDEX_NODE.size, prefix, length, left, right, value)
+            return number
+
+        make(0, len(items), 0, 0)
+        strings = bytearray()
+        table = bytearray()
+        for asn, country, org in values:
+            name = org.encode()[:0xFFFF]
+            table += AS_INDEX_VALUE.pack(asn, country.encode()[:2], len(strings), len(name))
+            strings += name
+        with open(index + '.tmp', 'wb') as f:
+            f.write(AS_INDEX_HEADER.pack(AS_INDEX_MAGIC, len(nodes) // AS_INDEX_NODE.size, len(values),
+                                         len(strings)))
+            f.write(nodes)
+            f.write(table)
+            f.write(strings)
+        os.replace(index + '.tmp', index)
+        return index
+
+    @staticmethod
+    def _read(source: str):
+        """
+        :return: итератор (IPv4Network, (asn, страна, организация)) из выгрузки
+        """
+        with open(source, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip() or line.startswith((';', '#')):
+                    continue
+                fields = line.rstrip('\r\n').split('\t') if '\t' in line else line.split()
+                try:
+                    if len(fields) >= 3:  # ip2asn: диапазон адресов
+                        asn = int(fields[2].removeprefix('AS'))
+                        if not asn:  # диапазон никем не анонсирован
+                            continue
+                        country = fields[3] if len(fields) > 3 and fields[3] != 'None' else ''
+                        org = fields[4] if len(fields) > 4 and fields[4] != 'Not routed' else ''
+                        for network in ipaddress.summarize_address_range(ipaddress.IPv4Address(fields[0]),
+                                                                          ipaddress.IPv4Address(fields[1])):
+                            yield network, (asn, country, org)
+                    else:  # pyasn: префикс и ASN
+                        yield ipaddress.IPv4Network(fields[0]), (int(fields[1]), '', '')
+                except ValueError:  # IPv6 и испорченные строки
+                    continue
+
+    def find(self, ip: str) -> tuple[int, str, str] | None:
+        """
+        :return: (asn, страна, организация) самого длинного префикса, содержащего ip, или None
+        """
+        try:
+            address = int.from_bytes(socket.inet_aton(ip), 'big')
+        except OSError:
+            return None
+        data, unpack, size, base = self._map, AS_INDEX_NODE.unpack_from, AS_INDEX_NODE.size, AS_INDEX_HEADER.size
+        node, best = 0, 0
+        while True:
+            prefix, length, left, right, value = unpack(data, base + node * size)
+            if length and (address ^ prefix) >> 32 - length:
+                break
+            if value:
+                best = value
+            if length == 32:
+                break
+            node = right if address >> 31 - length & 1 else left
+            if node == NO_CHILD:
+                break
+        if not best:
+            return None
+        asn, country, offset, length = AS_INDEX_VALUE.unpack_from(data, self._values + (best - 1) *
+                                                                   AS_INDEX_VALUE.size)
+        start = self._strings + offset
+        return asn, country.rstrip(b'\0').decode(), data[start:start + length].decode()
+
+    def get(self, ip: str) -> ASResponse:
+        found = self.find(ip)
+        if found is None:
+            return ASResponse({'ip': ip})
+        asn, country, org = found
+        return ASResponse({'ip': ip, 'org': f'AS{asn} {org}'.strip(), 'country': country})
+
+    def get_many(self, ips: list[str]) -> dict:
+        """
+        Пакетный поиск.
+        :return: словарь ip -> ASResponse
+        """
+        return {ip: self.get(ip) for ip in dict.fromkeys(ips)}
+
+    def submit(self, ip: str) -> Future:
+        future = Future()
+        future.set_result(self.get(ip))
+        return future
+
+    def close(self):
+        self._map.close()
+
+
+def get_route(address: str, protocol: str = 'udp', max_hops: int = MAX_HOPS, timeout: float = TIMEOUT,
+              lookup: ASLookup | ASIndex = None):
     """
     Непосредственно функция получения пути следования пакета от нас до цели.
+    На Linux - собственная параллельная трассировка (Tracer), на Windows - разбор вывода tracert.
+    """
+    lookup = lookup or ASLookup()
+    try:
+        if Tracer.supported():
+            asyncio.run(trace_route(address, protocol, max_hops, timeout, lookup))
+        else:
+            get_route_tracert(address, lookup)
+    finally:
+        lookup.close()
+
+
+async def trace_route(address: str, protocol: str, max_hops: int, timeout: float, as_lookup: ASLookup | ASIndex):
+    """
+    Трассировка Tracer'ом: AS узла запрашивается сразу, как узел ответил, строки печатаются по порядку TTL.
+    """
+    try:
+        destination = socket.gethostbyname(address)
+    except socket.gaierror:
+        print(phrases['ii'])
+        return
+    print(f"{phrases['tr']} к {address} [{destination}] {phrases['mh']} {max_hops}:\n")
+    lookups = {}  # ip -> future ASResponse
+
+    def lookup(ttl: int, ip: str):
+        if ip not in lookups:
+            lookups[ip] = asyncio.wrap_future(as_lookup.submit(ip))
+
+    output = Output()
+    tracer = Tracer(destination, protocol, max_hops, timeout, lookup)
+    try:
+        async for ttl, ip, rtt in tracer.trace():
+            if ip is None:
+                output.print('*', '--', '--', '--', '--')
+                continue
+            response = await lookups[ip]
+            output.print(ip, response.AS, response.country, response.city, response.provider)
+    except PermissionError:
+        print('ICMP sockets are not allowed for this user (net.ipv4.ping_group_range), use --protocol udp')
+        return
+    except OSError:
+        print(phrases['hu'])
+        return
+    print(phrases['tc'])
+
+
+def get_routes(addresses: list[str], protocol: str = 'udp', max_hops: int = MAX_HOPS, timeout: float = TIMEOUT,
+               rate: float = PROBE_RATE, concurrency: int = BATCH_CONCURRENCY, start_ttl: int = START_TTL,
+               lookup: ASLookup | ASIndex = None, graph_file: str = None):
+    """
+    Пакетная трассировка списка целей (только Linux): печатает маршруты и объединённый граф узлов с AS,
+    граф можно сохранить в JSON.
+    """
+    lookup = lookup or ASLookup()
+    try:
+        asyncio.run(trace_routes(addresses, protocol, max_hops, timeout, rate, concurrency, start_ttl, lookup,
+                                 graph_file))
+    finally:
+        lookup.close()
+
+
+async def trace_routes(addresses: list[str], protocol: str, max_hops: int, timeout: float, rate: float,
+                       concurrency: int, start_ttl: int, as_lookup: ASLookup | ASIndex, graph_file: str):
+    loop = asyncio.get_running_loop()
+    destinations = {}
+    for address in dict.fromkeys(addresses):
+        try:
+            destinations[address] = (await loop.getaddrinfo(address, None, family=socket.AF_INET))[0][4][0]
+        except socket.gaierror:
+            print(f'{address}: {phrases["ii"]}', end='')
+    lookups = {}  # ip -> future ASResponse
+
+    def lookup(ttl: int, ip: str):
+        if ip not in lookups:
+            lookups[ip] = asyncio.wrap_future(as_lookup.submit(ip))
+
+    tracer = BatchTracer(protocol, max_hops, timeout, rate, concurrency, start_ttl, lookup)
+    started = time.monotonic()
+    try:
+        routes = await tracer.trace(destinations)
+    except PermissionError:
+        print('ICMP sockets are not allowed for this user (net.ipv4.ping_group_range), use --protocol udp')
+        return
+    nodes, edges = tracer.graph()
+    responses = {ip: await lookups[ip] for ip in nodes}
+    for address, route in routes.items():
+        print(f'{address} [{destinations[address]}]: ' + ' > '.join(ip or '*' for ip in route))
+    print(f'\n{len(routes)} маршрутов за {time.monotonic() - started:.1f} с, {tracer.probes} проб, '
+          f'{tracer.skipped} узлов из стоп-множества; граф: {len(nodes)} узлов, {len(edges)} рёбер\n')
+    output = Output()
+    for ip in nodes:
+        response = responses[ip]
+        output.print(ip, response.AS, response.country, response.city, response.provider)
+    if graph_file:
+        with open(graph_file, 'w') as f:
+            dump({'nodes': {ip: {'as': response.AS, 'country': response.country, 'city': response.city,
+                                 'provider': response.provider} for ip, response in responses.items()},
+                  'edges': edges, 'routes': routes}, f, indent=1)
+
+
+def get_route_tracert(address: str, lookup: ASLookup | ASIndex):
+    """
+    Трассировка через Windows tracert с разбором его вывода.
     """
     tracert = subprocess.Popen(['tracert', address], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     get_as = False
@@ -126,7 +803,7 @@ def get_route(address: str):
             continue
 
         if get_as:
-            response = get_as_number_by_ip(ip)
+            response = lookup.get(ip)
             output.print(response.ip, response.AS, response.country, response.city, response.provider)
             if ip == ending:
                 print(phrases['tc'])
@@ -135,5 +812,39 @@ def get_route(address: str):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('address', type=str)
-    get_route(parser.parse_args().address)
+    parser.add_argument('address', type=str, nargs='?')
+    parser.add_argument('--protocol', choices=('udp', 'icmp'), default='udp', help='probe protocol (Linux)')
+    parser.add_argument('--max-hops', type=int, default=MAX_HOPS)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds to wait for all hops')
+    parser.add_argument('--endpoint', default=AS_ENDPOINT, help='AS lookup URL, {ip} is replaced by the address')
+    parser.add_argument('--as-cache', default=AS_CACHE_FILE, help='file of the AS lookup cache')
+    parser.add_argument('--asn-db', help='offline prefix to AS dump (pyasn or ip2asn-v4.tsv) or its built index')
+    parser.add_argument('--build-index', action='store_true', help='only build the index of --asn-db')
+    parser.add_argument('--batch', help='file of destinations, one per line, traced together (Linux)')
+    parser.add_argument('--rate', type=float, default=PROBE_RATE, help='probes per second for the whole batch')
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY, help='destinations traced at once')
+    parser.add_argument('--start-ttl', type=int, default=START_TTL, help='TTL the batch probes forward from')
+    parser.add_argument('--graph', help='write the merged route graph of the batch to this JSON file')
+    args = parser.parse_args()
+    if args.build_index and not args.asn_db:
+        parser.error('--build-index needs --asn-db')
+    try:
+        if args.build_index:
+            print(ASIndex.build(args.asn_db))
+            parser.exit()
+        lookup = ASIndex(args.asn_db) if args.asn_db else None
+    except OSError as e:
+        parser.error(f'--asn-db: {e}')
+    if lookup is None:
+        lookup = ASLookup(args.endpoint, args.as_cache)
+    if args.batch:
+        if not Tracer.supported():
+            parser.error('--batch needs Linux')
+        with open(args.batch) as f:
+            addresses = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        get_routes(addresses, args.protocol, args.max_hops, args.timeout, args.rate, args.concurrency,
+                   args.start_ttl, lookup, args.graph)
+    elif not args.address:
+        parser.error('the address is required')
+    else:
+        get_route(args.address, args.protocol, args.max_hops, args.timeout, lookup)
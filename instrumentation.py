@@ -0,0 +1,264 @@
+import collections
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STATS_HOST = '127.0.0.1'  # the endpoint is for the local operator only
+SUB_BUCKETS = 8  # histogram buckets per power of two, a value is off by under 1 / SUB_BUCKETS
+MAX_POWER = 40  # 2 ** 40 microseconds, about 12 days
+SUB_SHIFT = SUB_BUCKETS.bit_length()
+LAST_BUCKET = SUB_BUCKETS * (MAX_POWER + 1) - 1
+PERCENTILES = dict(p50=0.5, p99=0.99, p999=0.999)
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_DEPTH = 64
+
+
+class Counter:
+    """Plain integer counter, updated only by the thread it is measured in."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram:
+    """
+    Log-linear latency histogram over whole microseconds: exact below 2 * SUB_BUCKETS,
+    then SUB_BUCKETS equal buckets per power of two. Recording is a few integer operations.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (LAST_BUCKET + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = int(seconds * 1000000)
+        if micros >= SUB_BUCKETS:
+            shift = micros.bit_length() - SUB_SHIFT
+            micros = SUB_BUCKETS * shift + (micros >> shift)
+            if micros > LAST_BUCKET:
+                micros = LAST_BUCKET
+        self.counts[micros] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @staticmethod
+    def upper_bound(index):
+        """Largest value in microseconds that falls into the bucket."""
+        if index < 2 * SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the fraction of samples, in seconds, never above the maximum."""
+        if not self.count:
+            return 0.0
+        rank = max(1, round(self.count * fraction))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.upper_bound(index) / 1000000, self.max)
+        return self.max
+
+    def summary(self):
+        summary = dict(count=self.count, mean_ms=round(self.total / self.count * 1000, 3) if self.count else 0.0)
+        for name, fraction in PERCENTILES.items():
+            summary[f'{name}_ms'] = round(self.percentile(fraction) * 1000, 3)
+        summary['max_ms'] = round(self.max * 1000, 3)
+        return summary
+
+
+class Metrics:
+    """
+    Named counters and histograms of one process. The tools look them up once and keep the objects,
+    so the hot path costs one method call per update. Gauges are functions called only when the metrics
+    are read, for numbers the tools already keep (cache sizes, their own statistics).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        return self.counters.setdefault(name, Counter())
+
+    def histogram(self, name):
+        return self.histograms.setdefault(name, Histogram())
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        # read from another thread without locks, a value may be one update behind
+        return dict(name=self.name, pid=os.getpid(), time=round(time.time(), 3),
+                    uptime=round(time.time() - self.started, 3),
+                    counters={name: counter.value for name, counter in sorted(self.counters.items())},
+                    gauges={name: read() for name, read in sorted(self.gauges.items())},
+                    histograms={name: histogram.summary() for name, histogram in sorted(self.histograms.items())})
+
+
+class Profiler:
+    """
+    Opt-in sampling profiler: a thread looks at the stacks of the other threads every interval
+    and counts them in the collapsed format read by flamegraph.pl and speedscope. Threads in ignored,
+    the reporter's own, are left out.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.ignored = set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        self.ignored.add(threading.get_ident())
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident not in self.ignored:
+                    self.stacks[self.collapse(frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def collapse(frame):
+        names = []
+        while frame is not None and len(names) < PROFILE_DEPTH:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            f.write(self.collapsed())
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        reporter = self.server.reporter
+        if self.path == '/profile' and reporter.profiler is not None:
+            body, content_type = reporter.profiler.collapsed().encode(), 'text/plain'
+        elif self.path in ('/', '/stats'):
+            body, content_type = json.dumps(reporter.metrics.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Reporter:
+    """
+    Everything that reads the metrics runs in daemon threads of its own, away from the measured code:
+    the JSON endpoint on STATS_HOST:port, a JSON line on stderr every interval and the profiler.
+    """
+
+    def __init__(self, metrics, port=None, interval=None, profile=None):
+        self.metrics = metrics
+        self.port = port
+        self.interval = interval
+        self.profile = profile
+        self.profiler = Profiler() if profile else None
+        self.http = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        if self.port is not None:
+            self.http = ThreadingHTTPServer((STATS_HOST, self.port), StatsHandler)
+            self.http.daemon_threads = True
+            self.http.reporter = self
+            self.threads.append(threading.Thread(target=self.http.serve_forever, name='stats', daemon=True))
+        if self.interval:
+            self.threads.append(threading.Thread(target=self.dump, name='stats dump', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        if self.profiler is not None:
+            self.profiler.ignored.update(thread.ident for thread in self.threads)
+            self.profiler.start()
+        return self
+
+    def dump(self):
+        while not self.stopped.wait(self.interval):
+            self.print()
+
+    def print(self):
+        print(json.dumps(self.metrics.snapshot()), file=sys.stderr, flush=True)
+
+    def close(self):
+        """Stops the threads, prints the final numbers if dumping and writes the profile."""
+        self.stopped.set()
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.save(self.profile)
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+        if self.interval:
+            self.print()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--stats-port', type=int, metavar='PORT',
+                       help=f'serve counters and latency histograms as JSON on {STATS_HOST}:PORT, '
+                            f'collapsed stacks on /profile')
+    group.add_argument('--stats-interval', type=float, metavar='SECONDS',
+                       help='print the metrics as a JSON line to stderr every so many seconds')
+    group.add_argument('--profile', metavar='FILE',
+                       help=f'sample stacks every {PROFILE_INTERVAL * 1000:g} ms and write them to FILE '
+                            f'in collapsed format on exit')
+
+
+def options(arguments):
+    """Keyword arguments of Reporter from the options added by add_arguments."""
+    return dict(port=arguments.stats_port, interval=arguments.stats_interval, profile=arguments.profile)
+
+
+def worker_options(reporting, number):
+    """Reporter options of the worker process number: the next port and a profile file of its own."""
+    reporting = dict(reporting)
+    if reporting.get('port') is not None:
+        reporting['port'] += number
+    if reporting.get('profile'):
+        reporting['profile'] = f'{reporting["profile"]}.{number}'
+    return reporting